@@ -2,13 +2,12 @@ import dash
 import dash_auth
 
 import logging
+import re
 import sqlite3
 
 import dash_bootstrap_components as dbc
-import pandas as pd
-import plotly.express as px
 
-from dash import dash_table, html, dcc
+from dash import dash_table, html, dcc, no_update
 from dash.dependencies import Input, Output, State
 from dash.exceptions import PreventUpdate
 from datetime import datetime
@@ -16,59 +15,74 @@ from datetime import datetime
 logging.basicConfig(level=logging.INFO)
 
 # Import the required functions from db.py
-from db import create_connection, create_tables, insert_player, update_player, delete_player, get_all_players,\
-               get_game_history, add_game_result, get_table, get_columns, update_row_in_db, delete_row_from_db
+from db import get_connection, ensure_tables, insert_player, update_player, delete_player, get_all_players,\
+               get_game_history, add_game_result, get_table, get_columns, update_row_in_db, delete_row_from_db,\
+               get_game_key, rerate_after_edit, get_table_page, count_table_rows,\
+               get_earliest_game_key, apply_table_changes, get_game_pairs, GAME_TABLES
 
 
-# Create a connection to the database and create the table if it doesn't exist
-conn = create_connection()
-database_name = 'leaderboard.db'
-create_tables(conn)
-
 app = dash.Dash(__name__, external_stylesheets=[dbc.themes.ZEPHYR])
 server = app.server
 
+@server.before_request
+def prepare_database():
+    # Every request, callbacks included, as one can arrive before any page load, e.g. from
+    # a tab left open across a restart. Done per process on the first one.
+    ensure_tables()
+
 # Functions to fetch data from the databases, edit, insert, and delete rows.
 # Please provide the existing functions or create new ones as needed.
 
-# Layout
-app.layout = html.Div([
-    html.H1("Admin Dashboard"),
-    dcc.Link("Go to Main App", href="/"),
-
-    dcc.Dropdown(
-        id="database_dropdown",
-        options=[
-            {"label": "leaderboard", "value": "leaderboard.db"},
-        ],
-        placeholder="Select a database"
-    ),
-
-    dcc.Dropdown(
-        id="table_dropdown",
-        options=[],
-        placeholder="Select a table"
-    ),
-
-    html.Button("View Table", id="view_table_btn"),
-    html.Button("Insert", id="insert_btn"),
-    html.Button("Edit", id="submit_update_btn"),
-    html.Button("Delete", id="submit_delete_btn"),
-
-    dcc.Input(id="row_id", placeholder="Row ID", type="number"),
-    dcc.Input(id="column_name", placeholder="Column Name"),
-    dcc.Input(id="new_value", placeholder="New Value"),
-
-    html.Div(id="table_change_output"),
-
-    dash_table.DataTable(
-    id="table_view",
-    style_table={"overflowX": "auto"},
-    editable=True,
-    row_deletable=True,
-    ),
-
-])
+# Layout, evaluated on every page load so importing this module does no database work
+def layout():
+    return html.Div([
+        html.H1("Admin Dashboard"),
+        dcc.Link("Go to Main App", href="/"),
+
+        dcc.Dropdown(
+            id="database_dropdown",
+            options=[
+                {"label": "leaderboard", "value": "leaderboard.db"},
+            ],
+            placeholder="Select a database"
+        ),
+
+        dcc.Dropdown(
+            id="table_dropdown",
+            options=[],
+            placeholder="Select a table"
+        ),
+
+        html.Button("View Table", id="view_table_btn"),
+        html.Button("Insert", id="insert_btn"),
+        html.Button("Edit", id="submit_update_btn"),
+        html.Button("Delete", id="submit_delete_btn"),
+
+        dcc.Input(id="row_id", placeholder="Row ID", type="number"),
+        dcc.Input(id="column_name", placeholder="Column Name"),
+        dcc.Input(id="new_value", placeholder="New Value"),
+
+        html.Div(id="table_change_output"),
+        html.Div(id="table_edit_output"),
+
+        dash_table.DataTable(
+        id="table_view",
+        style_table={"overflowX": "auto"},
+        editable=True,
+        row_deletable=True,
+        page_action="custom",
+        page_current=0,
+        page_size=25,
+        sort_action="custom",
+        sort_mode="multi",
+        sort_by=[],
+        filter_action="custom",
+        filter_query="",
+        ),
+
+    ])
+
+app.layout = layout
 
 # Callbacks and other logic here
 # You'll need to create callbacks to handle user interactions, update the UI elements, and execute the database functions.
@@ -89,26 +103,84 @@ def update_table_options(database_name):
     tables = get_table(database_name)
     return [{"label": table, "value": table} for table in tables]
 
+# Dash filter operators and their get_table_page equivalents
+FILTER_OPERATORS = {
+    "ge": ">=", "le": "<=", "lt": "<", "gt": ">", "ne": "!=", "eq": "=",
+    ">=": ">=", "<=": "<=", "<": "<", ">": ">", "!=": "!=", "=": "=",
+    "contains": "contains", "datestartswith": "startswith",
+}
+FILTER_PART = re.compile(r"^\s*\{(?P<column>[^}]+)\}\s+(?P<operator>\S+)\s+(?P<value>.*?)\s*$")
+
+def parse_filter_query(filter_query):
+    # Translate the DataTable filter_query ("{col} op value && ...") into (column, operator, value)
+    filters = []
+    for part in (filter_query or "").split(" && "):
+        match = FILTER_PART.match(part)
+        if not match or match["operator"] not in FILTER_OPERATORS:
+            continue
+        value = match["value"]
+        operator = FILTER_OPERATORS[match["operator"]]
+        if len(value) > 1 and value[0] == value[-1] and value[0] in ("'", '"', "`"):
+            value = value[1:-1].replace("\\" + value[0], value[0])
+        elif operator not in ("contains", "startswith"):
+            # Numbers compare as numbers; text patterns keep what was typed, so 2023 stays "2023"
+            try:
+                value = float(value)
+            except ValueError:
+                pass
+        filters.append((match["column"], operator, value))
+    return filters
+
+def load_page(database_name, table_name, page_current, page_size, sort_by, filter_query):
+    # One page of the table as the DataTable asks for it
+    sort = [(column["column_id"], column["direction"]) for column in sort_by or []]
+    return get_table_page(database_name, table_name, page_current or 0, page_size, sort,
+                          parse_filter_query(filter_query))
+
 # Callback to view the tables
 
 @app.callback(
     Output("table_view", "data"),
     Output("table_view", "columns"),
+    Output("table_view", "editable"),
+    Output("table_view", "row_deletable"),
+    Output("table_view", "page_count"),
+    Output("table_view", "page_current"),
+    Output("table_view", "sort_by"),
+    Output("table_view", "filter_query"),
     Input("database_dropdown", "value"),
-    Input("table_dropdown", "value")
+    Input("table_dropdown", "value"),
+    Input("table_view", "page_current"),
+    Input("table_view", "page_size"),
+    Input("table_view", "sort_by"),
+    Input("table_view", "filter_query"),
+    State("table_view", "page_count"),
 )
-def view_table(database_name, table_name):
+def view_table(database_name, table_name, page_current, page_size, sort_by, filter_query, page_count):
     if not database_name or not table_name:
-        return [], []
+        return [], [], False, False, None, 0, [], ""
+
+    # Another table starts on its first page, unsorted and unfiltered, as the columns of the
+    # previous one may not exist in it
+    changed_ids = [p["prop_id"] for p in dash.callback_context.triggered]
+    if any(p.startswith(("database_dropdown.", "table_dropdown.")) for p in changed_ids):
+        page_current, sort_by, filter_query = 0, [], ""
+        reset = (page_current, sort_by, filter_query)
+    else:
+        reset = (no_update, no_update, no_update)
 
-    conn = create_connection(database_name)
-    df = pd.read_sql(f"SELECT * FROM {table_name}", conn)
-    conn.close()
+    data = load_page(database_name, table_name, page_current, page_size, sort_by, filter_query)
+    columns = [{"name": col, "id": col} for col in get_columns(database_name, table_name)]
+    # Inline edits find their rows by id
+    editable = any(column["id"] == "id" for column in columns)
 
-    columns = [{"name": col, "id": col} for col in df.columns]
-    data = df.to_dict("records")
+    # Counting is a scan, so only recount when the set of matching rows can have changed
+    if page_count is None or not all(p.startswith(("table_view.page_current", "table_view.sort_by"))
+                                     for p in changed_ids):
+        filters = parse_filter_query(filter_query)
+        page_count = max(1, -(-count_table_rows(database_name, table_name, filters) // page_size))
 
-    return data, columns
+    return (data, columns, editable, editable, page_count) + reset
 
 @app.callback(
     Output("table_change_output", "children"),
@@ -127,16 +199,80 @@ def handle_table_changes(n_clicks_update, n_clicks_delete, database_name, table_
 
     button_id = ctx.triggered[0]["prop_id"].split(".")[0]
 
+    # Editing game history invalidates the ratings from that game onwards
+    previous_key = None
+    if table_name in GAME_TABLES:
+        conn = get_connection(database_name)
+        previous_key = get_game_key(conn, row_id)
+        previous_pairs = get_game_pairs(conn, [row_id])
+
     if button_id == "submit_update_btn":
         print(table_name, row_id, column_name, new_value)
         update_row_in_db(database_name, table_name, row_id, column_name, new_value)
-        return f"Updated row with ID {row_id} in the {table_name} table. Set {column_name} to {new_value}."
+        message = f"Updated row with ID {row_id} in the {table_name} table. Set {column_name} to {new_value}."
     elif button_id == "submit_delete_btn":
         print(database_name, table_name, row_id)
         delete_row_from_db(database_name, table_name, row_id)
-        return f"Deleted row with ID {row_id} from the {table_name} table."
+        message = f"Deleted row with ID {row_id} from the {table_name} table."
     else:
-        return ""
+        message = ""
+
+    if table_name in GAME_TABLES:
+        if message:
+            rerate_after_edit(conn, previous_key, [row_id], previous_pairs=previous_pairs)
+    return message
+
+@app.callback(
+    Output("table_edit_output", "children"),
+    Output("table_view", "data", allow_duplicate=True),
+    Input("table_view", "data_timestamp"),
+    State("table_view", "data"),
+    State("table_view", "data_previous"),
+    State("database_dropdown", "value"),
+    State("table_dropdown", "value"),
+    State("table_view", "page_current"),
+    State("table_view", "page_size"),
+    State("table_view", "sort_by"),
+    State("table_view", "filter_query"),
+    prevent_initial_call=True,
+)
+def apply_inline_edits(data_timestamp, data, data_previous, database_name, table_name,
+                       page_current, page_size, sort_by, filter_query):
+    if not database_name or not table_name or data_previous is None:
+        raise PreventUpdate
+    if "id" not in get_columns(database_name, table_name):
+        return (f"The {table_name} table has no id column, so it can't be edited here.",
+                load_page(database_name, table_name, page_current, page_size, sort_by, filter_query))
+
+    # Diff the visible page against its previous state by row id
+    current = {row["id"]: row for row in data or []}
+    previous = {row["id"]: row for row in data_previous}
+    deleted_ids = [row_id for row_id in previous if row_id not in current]
+    updates = [(row_id, column, value)
+               for row_id, row in current.items() if row_id in previous
+               for column, value in row.items() if previous[row_id].get(column) != value]
+    if not updates and not deleted_ids:
+        raise PreventUpdate
+
+    # Editing game history invalidates the ratings from the earliest touched game onwards
+    changed_ids = deleted_ids + list(dict.fromkeys(row_id for row_id, _, _ in updates))
+    if table_name in GAME_TABLES:
+        conn = get_connection(database_name)
+        previous_key = get_earliest_game_key(conn, changed_ids)
+        previous_pairs = get_game_pairs(conn, changed_ids)
+
+    # A rejected edit is rolled back as a whole, so show the rows as they are stored again
+    try:
+        apply_table_changes(database_name, table_name, updates, deleted_ids)
+    except (ValueError, sqlite3.Error) as e:
+        logging.warning("Edits to %s not applied: %s", table_name, e)
+        return (f"Edits not applied: {e}",
+                load_page(database_name, table_name, page_current, page_size, sort_by, filter_query))
+
+    if table_name in GAME_TABLES:
+        rerate_after_edit(conn, previous_key, changed_ids, previous_pairs=previous_pairs)
+    return (f"Applied {len(updates)} cell edits and {len(deleted_ids)} row deletions to the {table_name} table.",
+            no_update)
 
 
 
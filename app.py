@@ -1,8 +1,17 @@
+import os
+
 from flask import Flask, request, jsonify
+import numpy as np
+import db
 import elo
 
 app = Flask(__name__)
 
+@app.before_request
+def prepare_database():
+    # Done on the first request instead of at import, so workers boot without touching the database
+    db.ensure_tables()
+
 @app.route('/calculate_elo', methods=['POST'])
 def calculate_elo():
     data = request.get_json()
@@ -17,5 +26,102 @@ def calculate_elo():
         'player2_new_elo': new_elo2
     })
 
+@app.route('/calculate_elo/batch', methods=['POST'])
+def calculate_elo_batch():
+    data = request.get_json()
+    error = {'error': 'player1_elo, player2_elo and player1_result must be lists of numbers of equal length'}
+    try:
+        player1_elo = np.asarray(data['player1_elo'], dtype=np.float64)
+        player2_elo = np.asarray(data['player2_elo'], dtype=np.float64)
+        player1_result = np.asarray(data['player1_result'], dtype=np.float64)
+    except (TypeError, ValueError):
+        return jsonify(error), 400
+
+    if not (player1_elo.ndim == 1 and player1_elo.shape == player2_elo.shape == player1_result.shape):
+        return jsonify(error), 400
+    # null becomes NaN on conversion
+    if not all(np.isfinite(values).all() for values in (player1_elo, player2_elo, player1_result)):
+        return jsonify(error), 400
+
+    # Every game in the batch is independent, so one array call rates them all
+    new_elo1, new_elo2 = elo.update_elo(player1_elo, player2_elo, player1_result, k=data.get('k', 32))
+
+    return jsonify({
+        'player1_new_elo': new_elo1.tolist(),
+        'player2_new_elo': new_elo2.tolist()
+    })
+
+@app.route('/games', methods=['POST'])
+def submit_game():
+    data = request.get_json()
+    future = db.submit_game(data['player1'], data['player2'], data['result'])
+    try:
+        new_elo1, new_elo2 = future.result()
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    return jsonify({
+        'player1_new_elo': new_elo1,
+        'player2_new_elo': new_elo2
+    })
+
+@app.route('/predict', methods=['GET'])
+def predict():
+    # ?player1=...&player2=... for one match, otherwise every pair on the leaderboard
+    names, matrix = db.get_expected_scores()
+    player1 = request.args.get('player1')
+    player2 = request.args.get('player2')
+    if player1 is None and player2 is None:
+        return jsonify({'players': names, 'expected_scores': matrix.tolist()})
+
+    positions = {name: i for i, name in enumerate(names)}
+    for name in (player1, player2):
+        if name not in positions:
+            return jsonify({'error': f'Unknown player: {name}'}), 400
+    expected1 = matrix[positions[player1], positions[player2]]
+    return jsonify({
+        'player1_expected_score': expected1,
+        'player2_expected_score': 1 - expected1
+    })
+
+@app.route('/leaderboard', methods=['GET'])
+def leaderboard():
+    # ?as_of=YYYY-MM-DD[ HH:MM:SS] returns the standings at that moment
+    conn = db.get_connection()
+    as_of = request.args.get('as_of')
+    if as_of is None:
+        players = db.get_players(conn, by_rating=True)
+    else:
+        try:
+            players = db.get_leaderboard_as_of(conn, as_of)
+        except ValueError:
+            return jsonify({'error': f'Invalid as_of: {as_of}'}), 400
+
+    return jsonify({'as_of': as_of, 'players': players})
+
+@app.route('/games', methods=['GET'])
+def list_games():
+    # Keyset pagination: pass the returned next cursor back as before_timestamp/before_id.
+    # before_timestamp is epoch milliseconds, or an ISO datetime in server local time.
+    limit = min(request.args.get('limit', 50, type=int), 500)
+    before = None
+    if 'before_timestamp' in request.args and 'before_id' in request.args:
+        before = (request.args['before_timestamp'], request.args.get('before_id', type=int))
+
+    try:
+        games, next_cursor = db.get_game_history_page(db.get_connection(), before=before, limit=limit)
+    except ValueError:
+        return jsonify({'error': f'Invalid before_timestamp: {before[0]}'}), 400
+
+    return jsonify({
+        'games': games,
+        'next': {'before_timestamp': next_cursor[0], 'before_id': next_cursor[1]} if next_cursor else None
+    })
+
+@app.route('/stats/locks', methods=['GET'])
+def lock_stats():
+    # Write lock waits, retries and failures of the worker process that serves the request
+    return jsonify({'pid': os.getpid(), **db.get_lock_stats()})
+
 if __name__ == '__main__':
     app.run()
@@ -3,224 +3,449 @@ import dash_auth
 
 import logging
 import sqlite3
+import zlib
 
 import dash_bootstrap_components as dbc
-import pandas as pd
-import plotly.express as px
+import numpy as np
 
-from dash import dash_table, html, dcc
+from dash import Patch, dash_table, html, dcc, no_update
 from dash.dependencies import Input, Output, State
+from dash.exceptions import PreventUpdate
 from datetime import datetime
+from flask import has_request_context
 
 logging.basicConfig(level=logging.INFO)
 
 # Import the required functions from db.py
-from db import create_connection, create_tables, insert_player, update_player, delete_player, get_all_players, get_game_history, add_game_result
+from db import get_connection, ensure_tables, insert_player, delete_player, \
+               submit_game, get_game_history_page, cached_read, get_player, get_player_position, get_roster_token, \
+               search_players, get_rating_history, get_expected_scores, get_head_to_head, format_timestamp, get_players
+from downsample import lttb
 
 
-# Create a connection to the database and create the table if it doesn't exist
-conn = create_connection()
-database_name = 'leaderboard.db'
-create_tables(conn)
-
-# Replace your existing data variable with data from the database
-data = get_all_players(conn)
+LEADERBOARD_COLUMNS = ["id", "name", "elo", "games_played", "wins", "losses"]
+# Most matches a player dropdown shows while searching
+PLAYER_SEARCH_LIMIT = 20
+# Most points drawn per player in the rating history chart
+RATING_CHART_POINTS = 500
 
 app = dash.Dash(__name__, external_stylesheets=[dbc.themes.ZEPHYR])
 server = app.server
 
-app.layout = html.Div([
-    # Add player section
-    html.Div([
-        html.H3("Add Player"),
-        dcc.Input(id="add_name", placeholder="Name"),
-        dcc.Input(id="add_elo", placeholder="Elo", type="number"),
-        dbc.Button("Add Player", id="add_btn"),
-    ]),
-
-    html.Br(),
-
-    # Remove player section
-    html.Div([
-        html.H3("Remove Player"),
-        dcc.Dropdown(id="remove_player_dropdown", options=[]),
-        dbc.Button("Remove Player", id="remove_btn"),
-    ]),
-
-    html.Br(),
-
-    # Enter game results section
-    html.Div([
-        html.H3("Enter Game Result"),
-        dcc.Dropdown(id="player1_dropdown", options=[]),
-        dcc.Dropdown(id="player2_dropdown", options=[]),
-        dcc.RadioItems(id="game_result", options=[
-            {"label": "Player 1 Wins", "value": "p1_wins"},
-            {"label": "Player 2 Wins", "value": "p2_wins"},
+@server.before_request
+def prepare_database():
+    # Every request, callbacks included, as one can arrive before any page load, e.g. from
+    # a tab left open across a restart. Done per process on the first one.
+    ensure_tables()
+
+def layout():
+    # Evaluated on every page load, so importing this module does no database work. Dash
+    # also calls it once outside a request to validate the callbacks; that gets no data.
+    players, roster = [], None
+    if has_request_context():
+        # Dash builds the layout in its own first-request hook, which runs before prepare_database
+        ensure_tables()
+        players, roster = full_leaderboard(get_connection())
+
+    return html.Div([
+        # Add player section
+        html.Div([
+            html.H3("Add Player"),
+            dcc.Input(id="add_name", placeholder="Name"),
+            dcc.Input(id="add_elo", placeholder="Elo", type="number"),
+            dbc.Button("Add Player", id="add_btn"),
         ]),
-        dbc.Button("Submit Result", id="submit_result_btn"),
-    ]),
-
-    html.Br(),
-
-    # Leaderboard section
-    html.Div([
-        html.H3("Leaderboard"),
-        dash_table.DataTable(
-            id="leaderboard",
-            columns=[{"name": col, "id": col} for col in data.columns],
-            data=data.to_dict("records"),
-        ),
-    ]),
-    
-    # add some space between the sections
-    html.Br(),
 
-    html.H3("Game History"),
+        html.Br(),
 
-    dbc.Row([
-        dbc.Col([
-            dbc.Button("Update Game History", id="update_game_history_btn", className="mb-2")
-        ])
-    ]),
+        # Remove player section
+        html.Div([
+            html.H3("Remove Player"),
+            dcc.Dropdown(id="remove_player_dropdown", options=[], placeholder="Search players"),
+            dbc.Button("Remove Player", id="remove_btn"),
+        ]),
 
-    html.Br(),
+        html.Br(),
+
+        # Enter game results section
+        html.Div([
+            html.H3("Enter Game Result"),
+            dcc.Dropdown(id="player1_dropdown", options=[], placeholder="Search players"),
+            dcc.Dropdown(id="player2_dropdown", options=[], placeholder="Search players"),
+            dcc.RadioItems(id="game_result", options=[
+                {"label": "Player 1 Wins", "value": "p1_wins"},
+                {"label": "Player 2 Wins", "value": "p2_wins"},
+            ]),
+            dbc.Button("Submit Result", id="submit_result_btn"),
+        ]),
 
-    dbc.Row([
-        dbc.Col([
+        html.Br(),
+
+        # Leaderboard section
+        html.Div([
+            html.H3("Leaderboard"),
+            dbc.Button("Refresh Leaderboard", id="refresh_leaderboard_btn", className="mb-2"),
+            # Rows are kept in id order so single rows can be patched by position;
+            # the table itself sorts them by elo
             dash_table.DataTable(
-                id="game_history_table",
-                columns=[
-                    {"name": "ID", "id": "id"},
-                    {"name": "Timestamp", "id": "timestamp"},
-                    {"name": "Player 1", "id": "player1"},
-                    {"name": "Player 2", "id": "player2"},
-                    {"name": "Winner", "id": "winner"}
-                ],
-                data=[]
-            )
-        ])
-    ]),
-])
-
-def update_elo(rating1, rating2, k, score1):
-    e1 = 1 / (1 + 10 ** ((rating2 - rating1) / 400))
-    e2 = 1 / (1 + 10 ** ((rating1 - rating2) / 400))
-    
-    new_rating1 = rating1 + k * (score1 - e1)
-    new_rating2 = rating2 + k * ((1 - score1) - e2)
+                id="leaderboard",
+                columns=[{"name": col, "id": col} for col in LEADERBOARD_COLUMNS],
+                data=players,
+                sort_action="native",
+                sort_by=[{"column_id": "elo", "direction": "desc"}],
+            ),
+            # Roster token of the rows the browser holds, see db.get_roster_token
+            dcc.Store(id="leaderboard_roster", data=roster),
+            # Names of the players the last leaderboard update changed; None when it may have
+            # changed anyone. The charts redraw from it instead of from the full rows.
+            dcc.Store(id="leaderboard_changes", data=None),
+        ]),
     
-    return new_rating1, new_rating2
+        # add some space between the sections
+        html.Br(),
+
+        html.H3("Game History"),
+
+        dbc.Row([
+            dbc.Col([
+                dbc.Button("Update Game History", id="update_game_history_btn", className="mb-2")
+            ])
+        ]),
+
+        html.Br(),
+
+        dbc.Row([
+            dbc.Col([
+                dash_table.DataTable(
+                    id="game_history_table",
+                    columns=[
+                        {"name": "ID", "id": "id"},
+                        {"name": "Timestamp", "id": "timestamp"},
+                        {"name": "Player 1", "id": "player1"},
+                        {"name": "Player 2", "id": "player2"},
+                        {"name": "Winner", "id": "winner"}
+                    ],
+                    data=[],
+                    page_action="custom",
+                    page_current=0,
+                    page_size=10,
+                ),
+                # Keyset cursor at the start of every page visited so far
+                dcc.Store(id="game_history_pages", data=None),
+            ])
+        ]),
+
+        html.Br(),
+
+        # Win probability section
+        html.H3("Win Probabilities"),
+        dcc.Graph(id="win_probability_graph"),
+        # Roster token of the players the chart shows
+        dcc.Store(id="win_probability_roster", data=None),
+
+        html.Br(),
+
+        # Head-to-head section
+        html.H3("Head to Head"),
+        dcc.Graph(id="head_to_head_graph"),
+        # Token of the players the chart shows, see head_to_head_token
+        dcc.Store(id="head_to_head_players", data=None),
+
+        html.Br(),
+
+        # Rating history section
+        html.H3("Rating History"),
+        dcc.Dropdown(id="rating_history_players", options=[], multi=True, placeholder="Search players"),
+        dcc.Graph(id="rating_history_graph"),
+    ])
+
+app.layout = layout
+
+# Every leaderboard callback updates the same outputs: the table rows, the roster token and
+# the players that changed. They send Patches unless the browser's copy is out of step.
+LEADERBOARD_OUTPUTS = [
+    Output("leaderboard", "data", allow_duplicate=True),
+    Output("leaderboard_roster", "data", allow_duplicate=True),
+    Output("leaderboard_changes", "data", allow_duplicate=True),
+]
+
+def full_leaderboard(conn):
+    # Read back through the shared cache; it is invalidated by writes from any worker
+    players = cached_read("players", get_players)
+    return players, get_roster_token(conn)
+
+def added_token(roster, player_id, sign=1):
+    return [roster[0] + sign, roster[1] + sign * player_id]
 
 @app.callback(
-    Output("remove_player_dropdown", "options"),
-    Output("player1_dropdown", "options"),
-    Output("player2_dropdown", "options"),
     Output("leaderboard", "data"),
+    Output("leaderboard_roster", "data"),
+    Output("leaderboard_changes", "data"),
+    Input("refresh_leaderboard_btn", "n_clicks"),
+    prevent_initial_call=True,
+)
+def load_leaderboard(n_clicks):
+    return full_leaderboard(get_connection()) + (None,)
+
+@app.callback(
+    *LEADERBOARD_OUTPUTS,
     Input("add_btn", "n_clicks"),
-    Input("remove_btn", "n_clicks"),
-    Input("submit_result_btn", "n_clicks"),
     State("add_name", "value"),
     State("add_elo", "value"),
+    State("leaderboard_roster", "data"),
+    prevent_initial_call=True,
+)
+def add_player(n_clicks, name, elo, roster):
+    if not name or not elo:
+        return no_update, no_update, no_update
+
+    conn = get_connection()
+    try:
+        insert_player(conn, (name, float(elo), 0, 0, 0))
+    except sqlite3.IntegrityError:
+        logging.warning("Player %s already exists", name)
+        return no_update, no_update, no_update
+
+    # New ids are larger than all others, so the player goes at the end of the rows
+    player = get_player(conn, name)
+    if roster is None or get_roster_token(conn) != added_token(roster, player["id"]):
+        return full_leaderboard(conn) + (None,)
+
+    leaderboard = Patch()
+    leaderboard.append(player)
+    return leaderboard, added_token(roster, player["id"]), None
+
+@app.callback(
+    *LEADERBOARD_OUTPUTS,
+    Input("remove_btn", "n_clicks"),
     State("remove_player_dropdown", "value"),
+    State("leaderboard_roster", "data"),
+    prevent_initial_call=True,
+)
+def remove_player(n_clicks, name, roster):
+    if not name:
+        return no_update, no_update, no_update
+
+    conn = get_connection()
+    player = get_player(conn, name)
+    if player is None:
+        return full_leaderboard(conn) + (None,)
+    position = get_player_position(conn, player["id"])
+    delete_player(conn, name)
+
+    if roster is None or get_roster_token(conn) != added_token(roster, player["id"], sign=-1):
+        return full_leaderboard(conn) + (None,)
+
+    leaderboard = Patch()
+    del leaderboard[position]
+    return leaderboard, added_token(roster, player["id"], sign=-1), None
+
+@app.callback(
+    *LEADERBOARD_OUTPUTS,
+    Input("submit_result_btn", "n_clicks"),
     State("player1_dropdown", "value"),
     State("player2_dropdown", "value"),
-    State("game_result", "value")
+    State("game_result", "value"),
+    State("leaderboard_roster", "data"),
+    prevent_initial_call=True,
 )
-def update_leaderboard_and_add_player(
-    add_n_clicks, remove_n_clicks, submit_n_clicks,
-    name, elo,
-    remove_player_value, player1_value, player2_value, game_result_value
-):
-    global data
-    conn = create_connection()
-    changed_id = [p["prop_id"] for p in dash.callback_context.triggered][0]
+def submit_result(n_clicks, player1_value, player2_value, game_result_value, roster):
+    if not (player1_value and player2_value and game_result_value):
+        return no_update, no_update, no_update
+
+    # Record the game and both rating updates in one transaction, through the write
+    # queue when it is enabled; either way wait until the game is committed
+    try:
+        player1_elo, player2_elo = submit_game(player1_value, player2_value, game_result_value).result()
+    except ValueError as e:
+        logging.warning("Game not recorded: %s", e)
+        return no_update, no_update, no_update
+    logging.info("Recorded game: %s %s, %s %s", player1_value, player1_elo, player2_value, player2_elo)
+
+    conn = get_connection()
+    if roster is None or get_roster_token(conn) != roster:
+        return full_leaderboard(conn) + (None,)
+
+    # Only the two players' rows changed
+    leaderboard = Patch()
+    for name in (player1_value, player2_value):
+        player = get_player(conn, name)
+        leaderboard[get_player_position(conn, player["id"])] = player
+    return leaderboard, no_update, [player1_value, player2_value]
+
+def register_player_search(dropdown_id):
+    # Fill a player dropdown with the top matches for what is typed, instead of the full roster
+    @app.callback(
+        Output(dropdown_id, "options"),
+        Input(dropdown_id, "search_value"),
+        State(dropdown_id, "value"),
+        prevent_initial_call=True,
+    )
+    def search_player_options(search_value, value):
+        if not search_value:
+            raise PreventUpdate
+        names = search_players(search_value, limit=PLAYER_SEARCH_LIMIT)
+        # Keep the current selection available; multi dropdowns hold a list of names
+        for selected in (value if isinstance(value, list) else [value]):
+            if selected and selected not in names:
+                names.append(selected)
+        # The search text keeps fuzzy matches visible through the dropdown's own filtering
+        return [{"label": name, "value": name, "search": f"{name} {search_value}"} for name in names]
+
+for dropdown_id in ("remove_player_dropdown", "player1_dropdown", "player2_dropdown", "rating_history_players"):
+    register_player_search(dropdown_id)
 
-    if "add_btn" in changed_id and name and elo:
-        insert_player(conn, (name, float(elo), 0, 0, 0))
+@app.callback(
+    Output("win_probability_graph", "figure"),
+    Output("win_probability_roster", "data"),
+    Input("leaderboard_changes", "data"),
+    State("win_probability_roster", "data"),
+)
+def update_win_probability_graph(changed_players, chart_roster):
+    conn = get_connection()
+    roster = get_roster_token(conn)
+    names, matrix = get_expected_scores()
+    if changed_players is not None and chart_roster == roster:
+        # Only the changed players' rows and columns moved. Players are in id order, as in the leaderboard.
+        figure = Patch()
+        for name in changed_players:
+            i = get_player_position(conn, get_player(conn, name)["id"])
+            figure["data"][0]["z"][i] = matrix[i].tolist()
+            for j, score in enumerate(matrix[:, i].tolist()):
+                figure["data"][0]["z"][j][i] = score
+        return figure, no_update
+
+    # plotly is imported when the first chart is drawn rather than at worker boot
+    import plotly.graph_objects as go
+    # z is sent as nested lists, which Patches can index into
+    figure = go.Figure(go.Heatmap(
+        z=matrix.tolist(), x=names, y=names, zmin=0, zmax=1, colorscale="RdBu",
+        hovertemplate="%{y} vs %{x}: %{z:.0%}<extra></extra>",
+    ))
+    figure.update_layout(xaxis_title="Opponent", yaxis_title="Player", yaxis_autorange="reversed")
+    return figure, roster
+
+def head_to_head_matrix(conn):
+    # Share of games won by the row player against the column player, with hover text;
+    # pairs that never played are left empty
+    pairs = get_head_to_head(conn)
+    names = sorted({name for row in pairs for name in row[:2]})
+    position = {name: i for i, name in enumerate(names)}
+    share = np.full((len(names), len(names)), np.nan)
+    text = [[""] * len(names) for _ in names]
+    for player_a, player_b, a_wins, b_wins, last_timestamp, last_winner in pairs:
+        i, j = position[player_a], position[player_b]
+        share[i, j] = a_wins / (a_wins + b_wins)
+        share[j, i] = b_wins / (a_wins + b_wins)
+        last_played = format_timestamp(last_timestamp)[:10]
+        text[i][j] = f"{a_wins}-{b_wins}, last won by {last_winner} on {last_played}"
+        text[j][i] = f"{b_wins}-{a_wins}, last won by {last_winner} on {last_played}"
+    return names, share, text
+
+def head_to_head_token(names):
+    # Small stand-in for the chart's player list, so the browser needn't send the names back
+    return [len(names), zlib.crc32("\n".join(names).encode())]
 
-    if "remove_btn" in changed_id and remove_player_value:
-        delete_player(conn, remove_player_value)
-
-    if "submit_result_btn" in changed_id and player1_value and player2_value and game_result_value:
-        add_game_result(conn, player1_value, player2_value, game_result_value)
-        print(game_result_value)
-        if game_result_value == "p1_wins":
-            game_result_value = 1
-        elif game_result_value == "p2_wins":
-            game_result_value = 0
-        else:
-            ValueError("Invalid game result value")
-        # read in the current elo values
-        player1_elo = data.loc[data["name"] == player1_value, "elo"].values[0]
-        player2_elo = data.loc[data["name"] == player2_value, "elo"].values[0]
-        K = 32
-        # Update the player's elo
-        player1_elo, player2_elo = update_elo(player1_elo, player2_elo, K, game_result_value)
-        # round both elo to integers
-        player1_elo = int(round(player1_elo))
-        player2_elo = int(round(player2_elo))
-        # read in the other player attributes like games, wins, losses
-        print(data)
-        player1_games = data.loc[data["name"] == player1_value, "games_played"].values[0]
-        player1_wins = data.loc[data["name"] == player1_value, "wins"].values[0]
-        player1_losses = data.loc[data["name"] == player1_value, "losses"].values[0]
-
-        player2_games = data.loc[data["name"] == player2_value, "games_played"].values[0]
-        player2_wins = data.loc[data["name"] == player2_value, "wins"].values[0]
-        player2_losses = data.loc[data["name"] == player2_value, "losses"].values[0]
-
-        # update the player attributes
-        if game_result_value == "p1_wins":
-            player1_wins += 1
-            player2_losses += 1
-        elif game_result_value == "p2_wins":
-            player1_losses += 1
-            player2_wins += 1
-        else:
-            ValueError("Invalid game result value")
-
-        player1_games += 1
-        player2_games += 1
-
-        print(player1_games, player1_wins, player1_losses, player1_elo)
-        print(player2_games, player2_wins, player2_losses, player2_elo)
-
-        # update the player attributes in the database
-        update_player(conn, (player1_elo, int(player1_games), int(player1_wins), int(player1_losses), player1_value))
-        update_player(conn, (player2_elo, int(player2_games), int(player2_wins), int(player2_losses), player2_value))
-
-
-    data = get_all_players(conn)
-    print(data)
-    conn.close()
-    
-    player_options = [{"label": row["name"], "value": row["name"]} for _, row in data.iterrows()]
-    leaderboard_data = data.to_dict("records")
-    # sort the leaderboard by elo
-    leaderboard_data = sorted(leaderboard_data, key=lambda x: x["elo"], reverse=True)
-    return player_options, player_options, player_options, leaderboard_data
+@app.callback(
+    Output("head_to_head_graph", "figure"),
+    Output("head_to_head_players", "data"),
+    Input("leaderboard_changes", "data"),
+    State("head_to_head_players", "data"),
+)
+def update_head_to_head_graph(changed_players, chart_players):
+    names, share, text = cached_read("head_to_head", head_to_head_matrix)
+    token = head_to_head_token(names)
+    if changed_players is not None and chart_players == token:
+        # A result only changes the cells of the pair that played
+        position = {name: i for i, name in enumerate(names)}
+        figure = Patch()
+        for player_a in changed_players:
+            for player_b in changed_players:
+                if player_a != player_b and player_a in position and player_b in position:
+                    i, j = position[player_a], position[player_b]
+                    figure["data"][0]["z"][i][j] = float(share[i, j])
+                    figure["data"][0]["text"][i][j] = text[i][j]
+        return figure, no_update
+
+    import plotly.graph_objects as go
+    # Nested lists, with None for pairs that never played, so Patches can index into z
+    z = np.where(np.isnan(share), None, share).tolist()
+    figure = go.Figure(go.Heatmap(
+        z=z, x=names, y=names, text=text, zmin=0, zmax=1, colorscale="RdBu",
+        hovertemplate="%{y} vs %{x}: %{text}<extra></extra>",
+    ))
+    figure.update_layout(xaxis_title="Opponent", yaxis_title="Player", yaxis_autorange="reversed")
+    return figure, token
+
+def downsampled_rating_history(conn, name):
+    # At most RATING_CHART_POINTS points of a player's rating over time, chosen with LTTB
+    history = get_rating_history(conn, name)
+    if not history:
+        return [], []
+    timestamps, ratings = zip(*history)
+    keep = lttb(np.arange(len(ratings)), ratings, RATING_CHART_POINTS)
+    return [datetime.fromtimestamp(timestamps[i] / 1000) for i in keep], [ratings[i] for i in keep]
+
+@app.callback(
+    Output("rating_history_graph", "figure"),
+    Input("rating_history_players", "value"),
+)
+def update_rating_history_graph(players):
+    import plotly.graph_objects as go
+    figure = go.Figure()
+    for name in players or []:
+        timestamps, ratings = cached_read(("rating_history", name),
+                                          lambda conn: downsampled_rating_history(conn, name))
+        figure.add_trace(go.Scatter(x=timestamps, y=ratings, mode="lines", name=name))
+    figure.update_layout(xaxis_title="Date", yaxis_title="Elo")
+    return figure
 
 
 @app.callback(
     Output("game_history_table", "data"),
-    Input("update_game_history_btn", "n_clicks")
+    Output("game_history_table", "page_current"),
+    Output("game_history_table", "page_count"),
+    Output("game_history_pages", "data"),
+    Input("update_game_history_btn", "n_clicks"),
+    Input("game_history_table", "page_current"),
+    State("game_history_table", "page_size"),
+    State("game_history_pages", "data"),
 )
-def update_game_history_table(n_clicks):
-    # Check if the button has been clicked at least once
-
-    # Query the game_history table to fetch the last 10 games
-    with sqlite3.connect("leaderboard.db") as conn:
-        cursor = conn.cursor()
-        cursor.execute("SELECT * FROM game_history ORDER BY timestamp DESC LIMIT 10")
-        game_history = cursor.fetchall()
-        
-
-    # Convert the results to a list of dictionaries and return it
-    return [
-        {"id": row[0], "timestamp": row[1], "player1": row[2], "player2": row[3], "winner": row[4]}
-        for row in game_history
-    ]
+def update_game_history_table(n_clicks, page_current, page_size, pages):
+    conn = get_connection()
+    changed_id = [p["prop_id"] for p in dash.callback_context.triggered][0]
+
+    # Refreshing starts again from the newest game
+    if "update_game_history_btn" in changed_id or not pages:
+        page_current = 0
+        pages = {"cursors": [None], "last_page": None}
+    cursors = pages["cursors"]
+    last_page = pages["last_page"]
+    page_current = page_current or 0
+    if last_page is not None:
+        page_current = min(page_current, last_page)
+
+    # Walk forward from the furthest known page when jumping past it
+    while len(cursors) <= page_current:
+        _, next_cursor = get_game_history_page(conn, before=cursors[-1], limit=page_size)
+        if next_cursor is None:
+            last_page = page_current = len(cursors) - 1
+            break
+        cursors.append(next_cursor)
+
+    if page_current == 0:
+        # The newest page is what everyone looks at, so it is shared until the next write
+        games, next_cursor = cached_read(("history_page", page_size),
+                                         lambda conn: get_game_history_page(conn, limit=page_size))
+    else:
+        games, next_cursor = get_game_history_page(conn, before=cursors[page_current], limit=page_size)
+    if next_cursor is None:
+        last_page = page_current
+    elif page_current == len(cursors) - 1:
+        cursors.append(next_cursor)
+
+    page_count = last_page + 1 if last_page is not None else None
+    return games, page_current, page_count, {"cursors": cursors, "last_page": last_page}
 
 
 
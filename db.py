@@ -1,19 +1,212 @@
 # db.py
 
+import bisect
+import difflib
+import functools
+import logging
+import os
+import queue
+import random
 import sqlite3
+import threading
+import time
+from concurrent.futures import Future
 from sqlite3 import Error
-import pandas as pd
-from datetime import datetime
+import numpy as np
+from datetime import datetime, timedelta
+
+import elo
+
+logger = logging.getLogger(__name__)
+
+# Rating state is checkpointed every this many games so edits only re-rate from the nearest one
+CHECKPOINT_INTERVAL = 1000
+
+# Games per transaction when bulk importing
+IMPORT_CHUNK_SIZE = 10000
+
+# Indexes for the hot lookups; create_tables adds any that are missing, also on existing databases
+INDEXES = {
+    # Removed players keep their row, so only active names have to be unique
+    "idx_leaderboard_active_name": "CREATE UNIQUE INDEX IF NOT EXISTS idx_leaderboard_active_name "
+                                   "ON leaderboard(name) WHERE active = 1",
+    "idx_games_timestamp": "CREATE INDEX IF NOT EXISTS idx_games_timestamp ON games(timestamp)",
+    "idx_games_player1": "CREATE INDEX IF NOT EXISTS idx_games_player1 ON games(player1_id)",
+    "idx_games_player2": "CREATE INDEX IF NOT EXISTS idx_games_player2 ON games(player2_id)",
+    "idx_rating_history_player": "CREATE INDEX IF NOT EXISTS idx_rating_history_player "
+                                 "ON rating_history(player_id, timestamp, game_id)",
+    "idx_rating_history_timestamp": "CREATE INDEX IF NOT EXISTS idx_rating_history_timestamp "
+                                    "ON rating_history(timestamp, game_id)",
+}
+
+# games.outcome codes, by the result names used by record_game
+OUTCOMES = {"p1_wins": 1, "p2_wins": 2}
+
+# SQL expression turning a local-time text timestamp into epoch milliseconds, like to_epoch_ms
+TEXT_TO_EPOCH_MS = "CAST(ROUND((julianday({}, 'utc') - 2440587.5) * 86400000) AS INTEGER)"
+
+# Tables whose edits change game results; editing them calls for a re-rate
+GAME_TABLES = ("games", "game_history")
+
+# Prepared statements kept per connection; the app uses a few dozen distinct queries
+STATEMENT_CACHE_SIZE = 256
+
+# WAL lets readers run alongside a writer; NORMAL sync is durable in WAL mode except on power loss
+JOURNAL_MODE = os.environ.get("ELO_DB_JOURNAL_MODE", "WAL")
+SYNCHRONOUS = os.environ.get("ELO_DB_SYNCHRONOUS", "NORMAL")
+# How long SQLite itself waits on a locked database before a write attempt fails
+BUSY_TIMEOUT_MS = 5000
+# Failed write attempts are retried this many times with exponential backoff
+WRITE_RETRIES = 5
+RETRY_BACKOFF_SECONDS = 0.05
+
+# Applied once to every new connection
+CONNECTION_PRAGMAS = [
+    f"PRAGMA journal_mode = {JOURNAL_MODE}",
+    f"PRAGMA synchronous = {SYNCHRONOUS}",
+    f"PRAGMA busy_timeout = {BUSY_TIMEOUT_MS}",
+    "PRAGMA foreign_keys = ON",
+    "PRAGMA temp_store = MEMORY",
+    "PRAGMA cache_size = -16000",
+]
+
+# Per-thread connections, keyed by database file
+_local = threading.local()
+
+# Read results shared by every thread of this process, see cached_read
+_read_cache = {}
+_read_generations = {}
+_read_cache_lock = threading.Lock()
+
+# Expected-score matrix of the current leaderboard per database file, see get_expected_scores
+_expected_scores = {}
+_expected_scores_lock = threading.Lock()
+
+# Database files whose schema this process has brought up to date, see ensure_tables
+_tables_ready = set()
+_tables_ready_lock = threading.Lock()
+
+# Schema metadata per database file, see _schema
+_schema_cache = {}
+_schema_cache_lock = threading.Lock()
+
+# Lock contention metrics for this process, see get_lock_stats
+_lock_stats = {"writes": 0, "retries": 0, "failures": 0, "wait_seconds": 0.0, "max_wait_seconds": 0.0}
+_lock_stats_lock = threading.Lock()
+
+def _record_lock_wait(seconds, retried=False, failed=False):
+    with _lock_stats_lock:
+        _lock_stats["wait_seconds"] += seconds
+        _lock_stats["max_wait_seconds"] = max(_lock_stats["max_wait_seconds"], seconds)
+        _lock_stats["retries"] += retried
+        _lock_stats["failures"] += failed
+
+def get_lock_stats():
+    with _lock_stats_lock:
+        return dict(_lock_stats)
+
+def _is_lock_error(e):
+    message = str(e).lower()
+    return "locked" in message or "busy" in message
+
+def retry_on_lock(func):
+    # Retry a write that failed on lock contention, backing off exponentially with jitter.
+    # The transaction of a failed attempt is rolled back before retrying.
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        for attempt in range(WRITE_RETRIES + 1):
+            started = time.perf_counter()
+            try:
+                result = func(*args, **kwargs)
+                with _lock_stats_lock:
+                    _lock_stats["writes"] += 1
+                return result
+            except sqlite3.OperationalError as e:
+                if not _is_lock_error(e):
+                    raise
+                if args and isinstance(args[0], sqlite3.Connection) and args[0].in_transaction:
+                    args[0].rollback()
+                if attempt == WRITE_RETRIES:
+                    _record_lock_wait(time.perf_counter() - started, failed=True)
+                    logger.error("%s gave up after %d retries: %s", func.__name__, WRITE_RETRIES, e)
+                    raise
+                backoff = RETRY_BACKOFF_SECONDS * 2 ** attempt * (1 + random.random())
+                logger.warning("%s hit a locked database, retrying in %.2fs", func.__name__, backoff)
+                time.sleep(backoff)
+                _record_lock_wait(time.perf_counter() - started, retried=True)
+    return wrapper
+
+def begin_immediate(cursor):
+    # Start a write transaction now, timing how long we waited for the write lock
+    started = time.perf_counter()
+    cursor.execute("BEGIN IMMEDIATE")
+    _record_lock_wait(time.perf_counter() - started)
 
 def create_connection(db_file="leaderboard.db"):
     conn = None
     try:
-        conn = sqlite3.connect(db_file)
+        conn = sqlite3.connect(db_file, cached_statements=STATEMENT_CACHE_SIZE)
+        for pragma in CONNECTION_PRAGMAS:
+            conn.execute(pragma)
     except Error as e:
         print(e)
 
     return conn
 
+def get_connection(db_file="leaderboard.db"):
+    # Reuse this thread's connection to db_file instead of connecting per call.
+    # Callers must not close it. Connections inherited through a fork are dropped.
+    if getattr(_local, "pid", None) != os.getpid():
+        _local.pid = os.getpid()
+        _local.connections = {}
+    conn = _local.connections.get(db_file)
+    if conn is None:
+        conn = create_connection(db_file)
+        _local.connections[db_file] = conn
+    elif conn.in_transaction:
+        # A previous caller failed mid-transaction; don't let it leak into the next one
+        conn.rollback()
+    return conn
+
+def close_connections():
+    for conn in getattr(_local, "connections", {}).values():
+        conn.close()
+    _local.connections = {}
+
+def _read_generation(db_file):
+    # Bumped whenever this thread's connection sees a commit: PRAGMA data_version changes on
+    # commits by any other connection, in any process, and total_changes on our own.
+    conn = get_connection(db_file)
+    version = (conn, conn.execute("PRAGMA data_version").fetchone()[0], conn.total_changes)
+    seen = _local.__dict__.setdefault("seen_versions", {})
+    with _read_cache_lock:
+        if seen.get(db_file) != version:
+            seen[db_file] = version
+            _read_generations[db_file] = _read_generations.get(db_file, 0) + 1
+        return _read_generations[db_file]
+
+def cached_read(key, loader, db_file="leaderboard.db"):
+    # Return loader(conn) from a process-wide cache until the database changes.
+    # Cached values are shared between threads and must not be modified by callers.
+    generation = _read_generation(db_file)
+    with _read_cache_lock:
+        cached = _read_cache.get((db_file, key))
+    if cached is not None and cached[0] == generation:
+        return cached[1]
+    value = loader(get_connection(db_file))
+    with _read_cache_lock:
+        _read_cache[(db_file, key)] = (generation, value)
+    return value
+
+def ensure_tables(db_file="leaderboard.db"):
+    # Create or upgrade the schema once per process, on first use rather than at import
+    if db_file in _tables_ready:
+        return
+    with _tables_ready_lock:
+        # A failed setup, e.g. on a lock held by a long import, is tried again on the next use
+        if db_file not in _tables_ready and create_tables(get_connection(db_file)):
+            _tables_ready.add(db_file)
+
 def create_tables(conn):
     try:
         cursor = conn.cursor()
@@ -23,26 +216,256 @@ def create_tables(conn):
                             elo REAL NOT NULL,
                             games_played INTEGER NOT NULL,
                             wins INTEGER NOT NULL,
-                            losses INTEGER NOT NULL
+                            losses INTEGER NOT NULL,
+                            initial_elo REAL,
+                            active INTEGER NOT NULL DEFAULT 1
                         );""")
-        cursor.execute("""CREATE TABLE IF NOT EXISTS game_history (
-                            id INTEGER PRIMARY KEY,
-                            timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
-                            player1 TEXT NOT NULL,
-                            player2 TEXT NOT NULL,
-                            winner TEXT NOT NULL
+        upgrade_tables(conn)
+        cursor.execute(GAMES_TABLE)
+        # The name-based layout games were stored in before, kept for existing readers and writers.
+        # Timestamps are shown as local time text and may be written either way.
+        cursor.execute("""CREATE VIEW IF NOT EXISTS game_history AS
+                          SELECT g.id, strftime('%Y-%m-%d %H:%M:%f', g.timestamp / 1000.0, 'unixepoch', 'localtime')
+                                     AS timestamp,
+                                 p1.name AS player1, p2.name AS player2,
+                                 CASE g.outcome WHEN 1 THEN p1.name ELSE p2.name END AS winner
+                          FROM games g
+                          JOIN leaderboard p1 ON p1.id = g.player1_id
+                          JOIN leaderboard p2 ON p2.id = g.player2_id""")
+        new_timestamp_ms = TEXT_TO_EPOCH_MS.format("NEW.timestamp")
+        cursor.execute(f"""CREATE TRIGGER IF NOT EXISTS game_history_insert INSTEAD OF INSERT ON game_history
+                          BEGIN
+                              INSERT INTO games (id, timestamp, player1_id, player2_id, outcome)
+                              VALUES (NEW.id,
+                                      CASE typeof(NEW.timestamp)
+                                          WHEN 'null' THEN CAST(ROUND((julianday('now') - 2440587.5) * 86400000) AS INTEGER)
+                                          WHEN 'text' THEN {new_timestamp_ms}
+                                          ELSE NEW.timestamp END,
+                                      (SELECT id FROM leaderboard WHERE name = NEW.player1 AND active = 1),
+                                      (SELECT id FROM leaderboard WHERE name = NEW.player2 AND active = 1),
+                                      CASE NEW.winner WHEN NEW.player1 THEN 1 WHEN NEW.player2 THEN 2 END);
+                          END""")
+        # Unchanged names keep their player id, so games of removed players stay editable, and an
+        # unchanged winner keeps the outcome, so renaming a player's slot keeps its result.
+        # Replaced when its definition changed, dropping and creating it in one transaction so
+        # the view is never left without it.
+        update_trigger = f"""CREATE TRIGGER game_history_update INSTEAD OF UPDATE ON game_history
+                          BEGIN
+                              UPDATE games SET
+                                  id = NEW.id,
+                                  timestamp = CASE WHEN NEW.timestamp IS OLD.timestamp THEN timestamp
+                                                   WHEN typeof(NEW.timestamp) = 'text' THEN {new_timestamp_ms}
+                                                   ELSE NEW.timestamp END,
+                                  player1_id = CASE WHEN NEW.player1 IS OLD.player1 THEN player1_id
+                                                    ELSE (SELECT id FROM leaderboard WHERE name = NEW.player1 AND active = 1) END,
+                                  player2_id = CASE WHEN NEW.player2 IS OLD.player2 THEN player2_id
+                                                    ELSE (SELECT id FROM leaderboard WHERE name = NEW.player2 AND active = 1) END,
+                                  outcome = CASE WHEN NEW.winner IS OLD.winner THEN outcome
+                                                 ELSE CASE NEW.winner WHEN NEW.player1 THEN 1 WHEN NEW.player2 THEN 2 END
+                                            END
+                              WHERE id = OLD.id;
+                          END"""
+        cursor.execute("SELECT sql FROM sqlite_master WHERE type = 'trigger' AND name = 'game_history_update'")
+        if cursor.fetchone() != (update_trigger,):
+            begin_immediate(cursor)
+            try:
+                cursor.execute("DROP TRIGGER IF EXISTS game_history_update")
+                cursor.execute(update_trigger)
+                conn.commit()
+            except Error:
+                conn.rollback()
+                raise
+        cursor.execute("""CREATE TRIGGER IF NOT EXISTS game_history_delete INSTEAD OF DELETE ON game_history
+                          BEGIN
+                              DELETE FROM games WHERE id = OLD.id;
+                          END""")
+        cursor.execute("""CREATE TABLE IF NOT EXISTS rating_checkpoints (
+                            game_count INTEGER NOT NULL,
+                            game_timestamp INTEGER NOT NULL,
+                            game_id INTEGER NOT NULL,
+                            player_id INTEGER NOT NULL,
+                            elo REAL NOT NULL,
+                            games_played INTEGER NOT NULL,
+                            wins INTEGER NOT NULL,
+                            losses INTEGER NOT NULL,
+                            PRIMARY KEY (game_count, player_id)
                         );""")
+        cursor.execute("""CREATE TABLE IF NOT EXISTS rating_history (
+                            game_id INTEGER NOT NULL,
+                            player_id INTEGER NOT NULL,
+                            timestamp INTEGER NOT NULL,
+                            elo_before REAL NOT NULL,
+                            elo_after REAL NOT NULL,
+                            games_played INTEGER NOT NULL,
+                            wins INTEGER NOT NULL,
+                            losses INTEGER NOT NULL,
+                            PRIMARY KEY (game_id, player_id)
+                        );""")
+        # Per pair of players, stored once with player_a_id < player_b_id
+        cursor.execute("""CREATE TABLE IF NOT EXISTS head_to_head (
+                            player_a_id INTEGER NOT NULL,
+                            player_b_id INTEGER NOT NULL,
+                            a_wins INTEGER NOT NULL,
+                            b_wins INTEGER NOT NULL,
+                            last_game_id INTEGER NOT NULL,
+                            last_timestamp INTEGER NOT NULL,
+                            last_winner_id INTEGER NOT NULL,
+                            PRIMARY KEY (player_a_id, player_b_id)
+                        ) WITHOUT ROWID;""")
+        conn.commit()
+        create_indexes(conn)
+        backfill_rating_history(conn)
+        backfill_head_to_head(conn)
     except Error as e:
         print(e)
+        return False
+    return True
+
+# Game times are epoch milliseconds
+GAMES_TABLE = """CREATE TABLE IF NOT EXISTS games (
+                     id INTEGER PRIMARY KEY,
+                     timestamp INTEGER NOT NULL,
+                     player1_id INTEGER NOT NULL REFERENCES leaderboard(id),
+                     player2_id INTEGER NOT NULL REFERENCES leaderboard(id),
+                     outcome INTEGER NOT NULL CHECK (outcome IN (1, 2)),
+                     CHECK (player1_id <> player2_id)
+                 );"""
+
+def backfill_rating_history(conn):
+    # Databases from before rating_history get it filled by one full replay. The live
+    # leaderboard is left alone: stored ratings may not match a replay, for example when a
+    # starting rating was never recorded. Run `manage.py replay` to re-rate explicitly.
+    cursor = conn.cursor()
+    cursor.execute("SELECT EXISTS(SELECT 1 FROM games), EXISTS(SELECT 1 FROM rating_history)")
+    has_games, has_history = cursor.fetchone()
+    if has_games and not has_history:
+        logger.info("Backfilling rating history from game history")
+        rerate_from(conn, None, update_leaderboard=False)
+
+def backfill_head_to_head(conn):
+    # Databases from before head_to_head get it built once from the game history
+    cursor = conn.cursor()
+    cursor.execute("SELECT EXISTS(SELECT 1 FROM games), EXISTS(SELECT 1 FROM head_to_head)")
+    has_games, has_head_to_head = cursor.fetchone()
+    if has_games and not has_head_to_head:
+        logger.info("Building head-to-head statistics from game history")
+        rebuild_head_to_head(conn)
 
+def create_indexes(conn):
+    cursor = conn.cursor()
+    for name, sql in INDEXES.items():
+        try:
+            cursor.execute(sql)
+        except sqlite3.IntegrityError as e:
+            # Existing duplicates block a unique index; report them instead of failing startup
+            logger.warning("Could not create index %s: %s", name, e)
+    conn.commit()
+
+def upgrade_tables(conn):
+    # Bring databases created by older versions up to the current schema
+    cursor = conn.cursor()
+    leaderboard_columns = [row[1] for row in cursor.execute("PRAGMA table_info(leaderboard)")]
+    if "initial_elo" not in leaderboard_columns:
+        # The starting rating was never stored; it is only known for players without games
+        cursor.execute("ALTER TABLE leaderboard ADD COLUMN initial_elo REAL")
+        cursor.execute("UPDATE leaderboard SET initial_elo = CASE WHEN games_played = 0 THEN elo ELSE ? END",
+                       (elo.DEFAULT_RATING,))
+        conn.commit()
+    if "active" not in leaderboard_columns:
+        # Removing a player deactivates it, so its games can keep referring to it
+        cursor.execute("ALTER TABLE leaderboard ADD COLUMN active INTEGER NOT NULL DEFAULT 1")
+        cursor.execute("DROP INDEX IF EXISTS idx_leaderboard_name")
+        conn.commit()
+    cursor.execute("SELECT type FROM sqlite_master WHERE name = 'game_history'")
+    if cursor.fetchone() == ("table",):
+        migrate_game_history(conn)
+    cursor.execute("SELECT EXISTS(SELECT 1 FROM sqlite_master WHERE name = 'games')")
+    if cursor.fetchone()[0]:
+        # Text sorts after numbers, so the newest entry of the timestamp index tells
+        cursor.execute("SELECT typeof(timestamp) FROM games ORDER BY timestamp DESC LIMIT 1")
+        if cursor.fetchone() == ("text",):
+            convert_timestamps(conn)
+
+def migrate_game_history(conn):
+    # Move the name-based game_history table into games, which refers to players by id and
+    # stores an outcome code. The rating history, checkpoints and head-to-head tables were
+    # keyed by name as well; they are dropped and rebuilt from games by create_tables.
+    logger.info("Migrating game history to player ids")
+    cursor = conn.cursor()
+    begin_immediate(cursor)
+    try:
+        # Players removed before this version only live on in their games; they come back inactive
+        cursor.execute("""INSERT INTO leaderboard (name, elo, games_played, wins, losses, initial_elo, active)
+                          SELECT name, ?, 0, 0, 0, ?, 0
+                          FROM (SELECT player1 AS name FROM game_history UNION SELECT player2 FROM game_history)
+                          WHERE name NOT IN (SELECT name FROM leaderboard)""",
+                       (elo.DEFAULT_RATING, elo.DEFAULT_RATING))
+        cursor.execute(GAMES_TABLE)
+        # Some old rows store p1_wins/p2_wins instead of the winner's name. Games of a player
+        # against themselves are dropped, games no longer allow them.
+        cursor.execute(f"""INSERT INTO games (id, timestamp, player1_id, player2_id, outcome)
+                          WITH ids AS (SELECT name, MIN(id) AS id FROM leaderboard GROUP BY name)
+                          SELECT g.id, {TEXT_TO_EPOCH_MS.format("COALESCE(g.timestamp, CURRENT_TIMESTAMP)")},
+                                 p1.id, p2.id,
+                                 CASE WHEN g.winner IN (g.player1, 'p1_wins') THEN 1 ELSE 2 END
+                          FROM game_history g
+                          JOIN ids p1 ON p1.name = g.player1
+                          JOIN ids p2 ON p2.name = g.player2
+                          WHERE g.player1 <> g.player2""")
+        cursor.execute("DROP TABLE game_history")
+        for table in ("rating_checkpoints", "rating_history", "head_to_head"):
+            cursor.execute(f"DROP TABLE IF EXISTS {table}")
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+def convert_timestamps(conn):
+    # Turn the text timestamps of games and the tables derived from them into epoch milliseconds.
+    # The text was written as naive local time. The game_history view and its triggers are
+    # dropped and created again by create_tables.
+    logger.info("Converting game timestamps to epoch milliseconds")
+    cursor = conn.cursor()
+    begin_immediate(cursor)
+    try:
+        for table, column in (("games", "timestamp"), ("rating_history", "timestamp"),
+                              ("rating_checkpoints", "game_timestamp"), ("head_to_head", "last_timestamp")):
+            cursor.execute(f"""UPDATE {table} SET {column} = {TEXT_TO_EPOCH_MS.format(column)}
+                               WHERE typeof({column}) = 'text'""")
+        cursor.execute("DROP VIEW IF EXISTS game_history")
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+def to_epoch_ms(value):
+    # Epoch milliseconds for a datetime, an ISO string or a number of epoch milliseconds.
+    # Naive times are taken as local time.
+    if isinstance(value, (int, np.integer)):
+        return int(value)
+    if isinstance(value, str) and value.isdigit():
+        return int(value)
+    if not isinstance(value, datetime):
+        value = datetime.fromisoformat(str(value))
+    return round(value.timestamp() * 1000)
+
+def now_ms():
+    return time.time_ns() // 1_000_000
+
+def format_timestamp(ms):
+    # Local time text for epoch milliseconds, as the game_history view shows it
+    return datetime.fromtimestamp(ms / 1000).isoformat(" ", timespec="milliseconds")
+
+@retry_on_lock
 def insert_player(conn, player):
-    sql = """INSERT INTO leaderboard(name, elo, games_played, wins, losses)
-             VALUES(?,?,?,?,?)"""
+    sql = """INSERT INTO leaderboard(name, elo, games_played, wins, losses, initial_elo)
+             VALUES(?,?,?,?,?,?)"""
     cursor = conn.cursor()
-    cursor.execute(sql, player)
+    cursor.execute(sql, tuple(player) + (player[1],))
     conn.commit()
     return cursor.lastrowid
 
+@retry_on_lock
 def update_player(conn, player_data):
     sql = '''
         UPDATE leaderboard
@@ -50,7 +473,7 @@ def update_player(conn, player_data):
             games_played = ?,
             wins = ?,
             losses = ?
-        WHERE name = ?
+        WHERE name = ? AND active = 1
     '''
     cur = conn.cursor()
     cur.execute(sql, player_data)
@@ -59,65 +482,867 @@ def update_player(conn, player_data):
 
 
 
+@retry_on_lock
 def delete_player(conn, name):
-    sql = "DELETE FROM leaderboard WHERE name=?"
+    # Players are deactivated rather than deleted; their games still refer to them
+    sql = "UPDATE leaderboard SET active = 0 WHERE name = ? AND active = 1"
     cursor = conn.cursor()
     cursor.execute(sql, (name,))
     conn.commit()
 
+# Keys of the player dicts returned by get_players, get_player and get_leaderboard_as_of
+PLAYER_COLUMNS = ("id", "name", "elo", "games_played", "wins", "losses")
+
+PLAYERS_QUERY = """SELECT id, name, elo, CAST(games_played AS INTEGER) AS games_played,
+                          CAST(wins AS INTEGER) AS wins, CAST(losses AS INTEGER) AS losses
+                   FROM leaderboard WHERE active = 1"""
+
 def get_all_players(conn):
-    sql = "SELECT id, name, elo, CAST(games_played AS INTEGER) AS games_played, CAST(wins AS INTEGER) AS wins, CAST(losses AS INTEGER) AS losses FROM leaderboard"
-    df = pd.read_sql_query(sql, conn)
+    # pandas is only needed by the DataFrame helpers, so it is imported on first use;
+    # the web paths use get_players instead
+    import pandas as pd
+    df = pd.read_sql_query(PLAYERS_QUERY + " ORDER BY id", conn)
     return df
 
+def get_players(conn, by_rating=False):
+    # Active leaderboard rows as dicts, in id order or highest rating first
+    cursor = conn.cursor()
+    cursor.execute(PLAYERS_QUERY + (" ORDER BY elo DESC, id" if by_rating else " ORDER BY id"))
+    return [dict(zip(PLAYER_COLUMNS, row)) for row in cursor.fetchall()]
+
+def get_player(conn, name):
+    # A leaderboard row as a dict, or None
+    cursor = conn.cursor()
+    cursor.execute(PLAYERS_QUERY + " AND name = ?", (name,))
+    row = cursor.fetchone()
+    if row is None:
+        return None
+    return dict(zip(PLAYER_COLUMNS, row))
+
+def get_player_position(conn, player_id):
+    # Index of a player in the leaderboard ordered by id, as returned by get_players
+    cursor = conn.cursor()
+    cursor.execute("SELECT COUNT(*) FROM leaderboard WHERE id < ? AND active = 1", (player_id,))
+    return cursor.fetchone()[0]
+
+def _player_name_index(conn):
+    # Lowercased names in sorted order, with the original names alongside
+    keyed = sorted((name.lower(), name) for name, in conn.execute("SELECT name FROM leaderboard WHERE active = 1"))
+    return [key for key, _ in keyed], [name for _, name in keyed]
+
+def search_players(query, limit=20, db_file="leaderboard.db"):
+    # Player names matching query: prefix matches first, then substring, then fuzzy matches.
+    # The index is kept in memory and rebuilt only after the database changes.
+    keys, names = cached_read("player_name_index", _player_name_index, db_file)
+    query = query.lower()
+
+    matches = []
+    for i in range(bisect.bisect_left(keys, query), len(keys)):
+        if len(matches) == limit or not keys[i].startswith(query):
+            break
+        matches.append(names[i])
+    if len(matches) < limit:
+        found = set(matches)
+        for key, name in zip(keys, names):
+            if len(matches) == limit:
+                break
+            if query in key and name not in found:
+                matches.append(name)
+                found.add(name)
+    if len(matches) < limit:
+        found = set(matches)
+        by_key = dict(zip(keys, names))
+        for key in difflib.get_close_matches(query, keys, n=limit, cutoff=0.6):
+            if len(matches) == limit:
+                break
+            if by_key[key] not in found:
+                matches.append(by_key[key])
+    return matches
+
+def get_rating_history(conn, player):
+    # (epoch ms, rating after the game) for each of a player's games, oldest first
+    cursor = conn.cursor()
+    cursor.execute("""SELECT timestamp, elo_after FROM rating_history
+                      WHERE player_id = (SELECT id FROM leaderboard WHERE name = ? AND active = 1)
+                      ORDER BY timestamp, game_id""", (player,))
+    return cursor.fetchall()
+
+def get_leaderboard_as_of(conn, as_of):
+    # Standings at the end of `as_of` (a date or an ISO datetime), highest rating first.
+    # Each player's state is one index lookup into rating_history, so no games are replayed.
+    as_of = str(as_of)
+    if len(as_of) == 10:
+        # A bare date means the end of that day
+        before = to_epoch_ms(datetime.fromisoformat(as_of) + timedelta(days=1))
+    else:
+        before = to_epoch_ms(as_of) + 1
+    # The roster is taken from the games played by then, not from today's active players:
+    # removed players still show, and players without a game before the cutoff don't.
+    cursor = conn.cursor()
+    cursor.execute("""SELECT lb.id, lb.name, rh.elo_after AS elo, rh.games_played, rh.wins, rh.losses
+                      FROM leaderboard lb
+                      JOIN rating_history rh ON rh.rowid = (
+                          SELECT rowid FROM rating_history
+                          WHERE player_id = lb.id AND timestamp < ?
+                          ORDER BY timestamp DESC, game_id DESC LIMIT 1)
+                      ORDER BY elo DESC""", (before,))
+    return [dict(zip(PLAYER_COLUMNS, row)) for row in cursor.fetchall()]
+
+def get_expected_scores(db_file="leaderboard.db"):
+    # (names, matrix) where matrix[i, j] is the expected score of names[i] against names[j].
+    # After a game only the two players' rows and columns are recomputed. The matrix is
+    # shared between threads and must not be modified by callers.
+    generation = _read_generation(db_file)
+    with _expected_scores_lock:
+        cached = _expected_scores.get(db_file)
+        if cached is not None and cached[0] == generation:
+            return cached[1], cached[2].matrix
+        cursor = get_connection(db_file).cursor()
+        cursor.execute("SELECT id, name, elo FROM leaderboard WHERE active = 1 ORDER BY id")
+        rows = cursor.fetchall()
+        ids = [row[0] for row in rows]
+        names = [row[1] for row in rows]
+        ratings = [row[2] for row in rows]
+        if cached is not None and cached[3] == ids:
+            scores = cached[2]
+            scores.update(ratings)
+        else:
+            scores = elo.ExpectedScoreMatrix(ratings)
+        _expected_scores[db_file] = (generation, names, scores, ids)
+        return names, scores.matrix
+
+def get_roster_token(conn):
+    # Changes whenever players are added or removed; lets clients tell whether their copy
+    # of the roster is still in step with the database
+    cursor = conn.cursor()
+    cursor.execute("SELECT COUNT(*), TOTAL(id) FROM leaderboard WHERE active = 1")
+    count, id_total = cursor.fetchone()
+    return [count, int(id_total)]
+
 def get_game_history(conn):
+    import pandas as pd
     sql = "SELECT * FROM game_history"
     df = pd.read_sql_query(sql, conn)
     return df
 
+def get_game_history_page(conn, before=None, limit=10):
+    # Newest-first page of games strictly before the (epoch ms, id) cursor `before`.
+    # Returns the rows as dicts and the cursor for the next page, or None on the last page.
+    sql = """SELECT g.id, g.timestamp, p1.name, p2.name, CASE g.outcome WHEN 1 THEN p1.name ELSE p2.name END
+             FROM games g
+             JOIN leaderboard p1 ON p1.id = g.player1_id
+             JOIN leaderboard p2 ON p2.id = g.player2_id"""
+    params = []
+    if before is not None:
+        sql += " WHERE (g.timestamp, g.id) < (?, ?)"
+        params.extend((to_epoch_ms(before[0]), before[1]))
+    sql += " ORDER BY g.timestamp DESC, g.id DESC LIMIT ?"
+    params.append(limit + 1)
+
+    cursor = conn.cursor()
+    cursor.execute(sql, params)
+    rows = cursor.fetchall()
+    games = [{"id": row[0], "timestamp": format_timestamp(row[1]), "player1": row[2], "player2": row[3],
+              "winner": row[4]}
+             for row in rows[:limit]]
+    next_cursor = (rows[limit - 1][1], rows[limit - 1][0]) if len(rows) > limit else None
+    return games, next_cursor
+
+@retry_on_lock
 def add_game_result(conn, player1, player2, winner):
-    print("Submitting game result:", player1, player2, winner)
     if winner == "p2_wins":
         winner = player2
     elif winner == "p1_wins":
         winner = player1
 
+    if player1 == player2:
+        raise ValueError(f"{player1} can't play against themselves")
+
     # Insert game history data
-    with sqlite3.connect("leaderboard.db") as conn:
+    cursor = conn.cursor()
+    ids = _player_ids(cursor, (player1, player2))
+    if player1 not in ids or player2 not in ids:
+        raise ValueError(f"Unknown player in game: {player1} vs {player2}")
+    if winner not in (player1, player2):
+        raise ValueError(f"Winner {winner} did not play in {player1} vs {player2}")
+    timestamp = now_ms()
+    cursor.execute("INSERT INTO games (timestamp, player1_id, player2_id, outcome) VALUES (?, ?, ?, ?)",
+                   (timestamp, ids[player1], ids[player2], 1 if winner == player1 else 2))
+    cursor.executemany(HEAD_TO_HEAD_UPSERT, _head_to_head_rows(
+        [(cursor.lastrowid, timestamp, ids[player1], ids[player2], ids[winner])]))
+    conn.commit()
+    logger.info("Added game %s vs %s, won by %s", player1, player2, winner)
+
+def _player_ids(cursor, names):
+    # Ids of the active players among names, by name
+    names = list(names)
+    cursor.execute(f"""SELECT name, id FROM leaderboard WHERE active = 1 AND name IN ({",".join("?" * len(names))})""",
+                   names)
+    return dict(cursor.fetchall())
+
+RATING_HISTORY_INSERT = """INSERT INTO rating_history
+                           (game_id, player_id, timestamp, elo_before, elo_after, games_played, wins, losses)
+                           VALUES (?, ?, ?, ?, ?, ?, ?, ?)"""
+
+# Adds games to a pair's totals; the last result only moves forward in (timestamp, id) order
+HEAD_TO_HEAD_UPSERT = """INSERT INTO head_to_head
+                         (player_a_id, player_b_id, a_wins, b_wins, last_game_id, last_timestamp, last_winner_id)
+                         VALUES (?, ?, ?, ?, ?, ?, ?)
+                         ON CONFLICT (player_a_id, player_b_id) DO UPDATE SET
+                             a_wins = a_wins + excluded.a_wins,
+                             b_wins = b_wins + excluded.b_wins,
+                             last_game_id = CASE WHEN (excluded.last_timestamp, excluded.last_game_id) > (last_timestamp, last_game_id)
+                                                 THEN excluded.last_game_id ELSE last_game_id END,
+                             last_winner_id = CASE WHEN (excluded.last_timestamp, excluded.last_game_id) > (last_timestamp, last_game_id)
+                                                   THEN excluded.last_winner_id ELSE last_winner_id END,
+                             last_timestamp = MAX(excluded.last_timestamp, last_timestamp)"""
+
+def _head_to_head_rows(games):
+    # HEAD_TO_HEAD_UPSERT rows for (id, timestamp, player1_id, player2_id, winner_id) games, one per pair
+    pairs = {}
+    for game_id, timestamp, player1, player2, winner in games:
+        player_a, player_b = sorted((player1, player2))
+        row = pairs.setdefault((player_a, player_b), [player_a, player_b, 0, 0, game_id, timestamp, winner])
+        row[2] += winner == player_a
+        row[3] += winner == player_b
+        if (timestamp, game_id) > (row[5], row[4]):
+            row[4:] = [game_id, timestamp, winner]
+    return [tuple(row) for row in pairs.values()]
+
+def get_head_to_head(conn):
+    # (player_a, player_b, a_wins, b_wins, last_timestamp, last_winner) by name, for every
+    # pair of active players that has played
+    cursor = conn.cursor()
+    cursor.execute("""SELECT a.name, b.name, h.a_wins, h.b_wins, h.last_timestamp,
+                             CASE h.last_winner_id WHEN a.id THEN a.name ELSE b.name END
+                      FROM head_to_head h
+                      JOIN leaderboard a ON a.id = h.player_a_id
+                      JOIN leaderboard b ON b.id = h.player_b_id
+                      WHERE a.active = 1 AND b.active = 1
+                      ORDER BY h.player_a_id, h.player_b_id""")
+    return cursor.fetchall()
+
+def get_game_pairs(conn, game_ids):
+    # The distinct (player1_id, player2_id) pairs of the given games, in head_to_head order
+    game_ids = list(game_ids)
+    if not game_ids:
+        return set()
+    cursor = conn.cursor()
+    cursor.execute(f"""SELECT player1_id, player2_id FROM games WHERE id IN ({",".join("?" * len(game_ids))})""",
+                   game_ids)
+    return {tuple(sorted(pair)) for pair in cursor.fetchall()}
+
+@retry_on_lock
+def rebuild_head_to_head(conn, pairs=None):
+    # Recompute head_to_head from games, for the given (player_a_id, player_b_id) pairs or
+    # for everyone. Returns the number of pairs written.
+    where, params = "", []
+    if pairs is not None:
+        pairs = sorted({tuple(sorted(pair)) for pair in pairs})
+        if not pairs:
+            return 0
+        where = " WHERE " + " OR ".join(
+            ["(player1_id = ? AND player2_id = ?) OR (player1_id = ? AND player2_id = ?)"] * len(pairs))
+        params = [player_id for a, b in pairs for player_id in (a, b, b, a)]
+    with conn:
         cursor = conn.cursor()
-        cursor.execute("INSERT INTO game_history (timestamp, player1, player2, winner) VALUES (?, ?, ?, ?)",
-                       (datetime.now(), player1, player2, winner))
+        begin_immediate(cursor)
+        if pairs is None:
+            cursor.execute("DELETE FROM head_to_head")
+        else:
+            cursor.executemany("DELETE FROM head_to_head WHERE player_a_id = ? AND player_b_id = ?", pairs)
+        cursor.execute(f"""INSERT INTO head_to_head
+                               (player_a_id, player_b_id, a_wins, b_wins, last_game_id, last_timestamp, last_winner_id)
+                           WITH pair_games AS (
+                               SELECT id, timestamp, CASE outcome WHEN 1 THEN player1_id ELSE player2_id END AS winner,
+                                      MIN(player1_id, player2_id) AS a, MAX(player1_id, player2_id) AS b
+                               FROM games{where}
+                           ), ranked AS (
+                               SELECT *, ROW_NUMBER() OVER (PARTITION BY a, b ORDER BY timestamp DESC, id DESC) AS n,
+                                      SUM(winner = a) OVER pair AS a_wins, SUM(winner = b) OVER pair AS b_wins
+                               FROM pair_games WINDOW pair AS (PARTITION BY a, b)
+                           )
+                           SELECT a, b, a_wins, b_wins, id, timestamp, winner FROM ranked WHERE n = 1""", params)
+        return cursor.rowcount
+
+@retry_on_lock
+def record_game(conn, player1, player2, result, k=32):
+    # Insert the game and apply its rating change to both players in a single transaction
+    with conn:
+        cursor = conn.cursor()
+        # Take the write lock before reading the ratings, so a writer in another process
+        # can't update them between our read and our write
+        begin_immediate(cursor)
+        ratings = _record_game(cursor, player1, player2, result, k)
+        _checkpoint_if_due_quietly(cursor)
+        return ratings
+
+def _record_game(cursor, player1, player2, result, k=32):
+    # The statements of record_game; the caller owns the transaction
+    if result == "p1_wins":
+        winner, result1 = player1, 1
+    elif result == "p2_wins":
+        winner, result1 = player2, 0
+    else:
+        raise ValueError(f"Invalid game result value: {result}")
+    if player1 == player2:
+        raise ValueError(f"{player1} can't play against themselves")
+
+    cursor.execute("""SELECT name, id, elo, games_played, wins, losses FROM leaderboard
+                      WHERE name IN (?, ?) AND active = 1""", (player1, player2))
+    players = {row[0]: row[1:] for row in cursor.fetchall()}
+    if player1 not in players or player2 not in players:
+        raise ValueError(f"Unknown player in game: {player1} vs {player2}")
+    ids = {name: players[name][0] for name in (player1, player2)}
+    players = {name: row[1:] for name, row in players.items()}
+
+    timestamp = now_ms()
+    cursor.execute("INSERT INTO games (timestamp, player1_id, player2_id, outcome) VALUES (?, ?, ?, ?)",
+                   (timestamp, ids[player1], ids[player2], OUTCOMES[result]))
+    game_id = cursor.lastrowid
+
+    new_elo1, new_elo2 = elo.update_elo(players[player1][0], players[player2][0], result1, k=k)
+    new_elo1, new_elo2 = round(new_elo1), round(new_elo2)
+    cursor.executemany("""UPDATE leaderboard
+                          SET elo = ?,
+                              games_played = games_played + 1,
+                              wins = wins + ?,
+                              losses = losses + ?
+                          WHERE id = ?""",
+                       [(new_elo1, result1, 1 - result1, ids[player1]),
+                        (new_elo2, 1 - result1, result1, ids[player2])])
+    cursor.executemany(RATING_HISTORY_INSERT, [
+        (game_id, ids[name], timestamp, players[name][0], new_elo, players[name][1] + 1,
+         players[name][2] + won, players[name][3] + 1 - won)
+        for name, new_elo, won in ((player1, new_elo1, result1), (player2, new_elo2, 1 - result1))])
+    cursor.executemany(HEAD_TO_HEAD_UPSERT, _head_to_head_rows(
+        [(game_id, timestamp, ids[player1], ids[player2], ids[winner])]))
+    return new_elo1, new_elo2
+
+def _rating_history_rows(games, player1_idx, player2_idx, player_ids, history, games_played, wins, losses):
+    # rating_history rows for games replayed with elo.replay_history(history=True); the
+    # counters arrays hold each player's totals from before the replay
+    history = history.copy()
+    width = len(elo.HISTORY_COLUMNS)
+    for side, idx in ((0, player1_idx), (1, player2_idx)):
+        history[:, side * width + 2] += games_played[idx]
+        history[:, side * width + 3] += wins[idx]
+        history[:, side * width + 4] += losses[idx]
+    rows = []
+    for (game_id, timestamp), i, j, row in zip(games, player1_idx.tolist(), player2_idx.tolist(), history.tolist()):
+        rows.append((game_id, player_ids[i], timestamp, row[0], row[1], int(row[2]), int(row[3]), int(row[4])))
+        rows.append((game_id, player_ids[j], timestamp, row[5], row[6], int(row[7]), int(row[8]), int(row[9])))
+    return rows
+
+@retry_on_lock
+def _record_game_batch(conn, games):
+    # Apply queued games in order in one transaction. Each game runs in its own savepoint,
+    # so an invalid game is rolled back on its own and reported without failing the batch.
+    outcomes = []
+    with conn:
+        cursor = conn.cursor()
+        begin_immediate(cursor)
+        for game in games:
+            cursor.execute("SAVEPOINT game")
+            try:
+                outcomes.append((True, _record_game(cursor, *game)))
+            except (ValueError, sqlite3.IntegrityError) as e:
+                cursor.execute("ROLLBACK TO game")
+                outcomes.append((False, e))
+            cursor.execute("RELEASE game")
+        _checkpoint_if_due_quietly(cursor)
+    return outcomes
+
+class WriteQueue:
+    # Single writer thread that applies submitted games in order, committing them in batches
+    # of at most max_batch games or max_delay seconds. submit returns a Future that resolves
+    # to the new ratings once the batch containing the game is committed.
+
+    def __init__(self, db_file="leaderboard.db", max_batch=100, max_delay=0.05):
+        self.db_file = db_file
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name="elo-write-queue", daemon=True)
+        self._thread.start()
+
+    def submit(self, player1, player2, result):
+        future = Future()
+        self._queue.put(((player1, player2, result), future))
+        return future
+
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
+
+    def _run(self):
+        conn = create_connection(self.db_file)
+        stopping = False
+        while not stopping:
+            item = self._queue.get()
+            if item is None:
+                break
+            batch = [item]
+            deadline = time.monotonic() + self.max_delay
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+            self._apply(conn, batch)
+        conn.close()
+
+    def _apply(self, conn, batch):
+        try:
+            outcomes = _record_game_batch(conn, [game for game, _ in batch])
+        except Exception as e:
+            logger.exception("Write queue failed to apply a batch of %d games", len(batch))
+            outcomes = [(False, e)] * len(batch)
+        for (_, future), (ok, value) in zip(batch, outcomes):
+            if ok:
+                future.set_result(value)
+            else:
+                future.set_exception(value)
+
+# Whether submit_game goes through a background WriteQueue instead of writing inline
+USE_WRITE_QUEUE = os.environ.get("ELO_DB_WRITE_QUEUE", "0") == "1"
+
+_write_queues = {}
+_write_queues_lock = threading.Lock()
+
+def get_write_queue(db_file="leaderboard.db"):
+    # One queue per database file and process; a queue inherited through a fork has no thread
+    with _write_queues_lock:
+        pid, write_queue = _write_queues.get(db_file, (None, None))
+        if pid != os.getpid():
+            write_queue = WriteQueue(db_file)
+            _write_queues[db_file] = (os.getpid(), write_queue)
+        return write_queue
+
+def submit_game(player1, player2, result, db_file="leaderboard.db"):
+    # Record a game through the write queue when enabled, otherwise right away.
+    # Either way the returned Future resolves once the game is committed.
+    if USE_WRITE_QUEUE:
+        return get_write_queue(db_file).submit(player1, player2, result)
+
+    future = Future()
+    conn = get_connection(db_file)
+    try:
+        future.set_result(record_game(conn, player1, player2, result))
+    except Exception as e:
+        future.set_exception(e)
+    return future
+
+def _checkpoint_quietly(conn):
+    # The games are already committed, so a failed checkpoint must not be reported as a failed game
+    try:
+        checkpoint_if_due(conn)
+    except Error:
+        logger.exception("Could not store a rating checkpoint")
+
+def replay_game_history(conn, k=32):
+    # Recompute every player's rating and counters from scratch out of game_history
+    return rerate_from(conn, None, k=k)
+
+def get_game_key(conn, game_id):
+    # The (timestamp, id) position of a game in rating order, or None if it doesn't exist
+    cursor = conn.cursor()
+    cursor.execute("SELECT timestamp, id FROM games WHERE id = ?", (game_id,))
+    return cursor.fetchone()
+
+def get_earliest_game_key(conn, game_ids):
+    # The first (timestamp, id) position among the given games, or None if none exist
+    game_ids = list(game_ids)
+    if not game_ids:
+        return None
+    cursor = conn.cursor()
+    cursor.execute(f"""SELECT timestamp, id FROM games WHERE id IN ({",".join("?" * len(game_ids))})
+                       ORDER BY timestamp, id LIMIT 1""", game_ids)
+    return cursor.fetchone()
+
+def rerate_after_edit(conn, previous_key, game_ids, k=32, previous_pairs=()):
+    # An edit can move games, so re-rate from the earliest of their old and new positions.
+    # The head-to-head totals of the games' old and new pairs are recomputed as well.
+    rebuild_head_to_head(conn, set(previous_pairs) | get_game_pairs(conn, game_ids))
+    keys = [key for key in (previous_key, get_earliest_game_key(conn, game_ids)) if key is not None]
+    if keys:
+        rerate_from(conn, min(keys), k=k)
+
+@retry_on_lock
+def rerate_from(conn, since, k=32, update_leaderboard=True):
+    # Re-rate every game at or after the (timestamp, id) key `since`, starting from the
+    # nearest checkpoint before it. since=None replays the full history. With
+    # update_leaderboard=False only the rating history and checkpoints are rewritten.
+    cursor = conn.cursor()
+    if not conn.in_transaction:
+        begin_immediate(cursor)
+    checkpoint = None
+    if since is not None:
+        cursor.execute("""SELECT game_count, game_timestamp, game_id FROM rating_checkpoints
+                          WHERE (game_timestamp, game_id) < (?, ?)
+                          ORDER BY game_count DESC LIMIT 1""", tuple(since))
+        checkpoint = cursor.fetchone()
+
+    if checkpoint:
+        game_count, checkpoint_timestamp, checkpoint_game_id = checkpoint
+        state = {row[0]: row[1:] for row in cursor.execute(
+            "SELECT player_id, elo, games_played, wins, losses FROM rating_checkpoints WHERE game_count = ?",
+            (game_count,))}
+        cursor.execute("DELETE FROM rating_checkpoints WHERE game_count > ?", (game_count,))
+        cursor.execute("DELETE FROM rating_history WHERE (timestamp, game_id) > (?, ?)",
+                       (checkpoint_timestamp, checkpoint_game_id))
+        games = cursor.execute("""SELECT id, timestamp, player1_id, player2_id, outcome FROM games
+                                  WHERE (timestamp, id) > (?, ?) ORDER BY timestamp, id""",
+                               (checkpoint_timestamp, checkpoint_game_id)).fetchall()
+    else:
+        game_count = 0
+        state = {}
+        cursor.execute("DELETE FROM rating_checkpoints")
+        cursor.execute("DELETE FROM rating_history")
+        games = cursor.execute(
+            "SELECT id, timestamp, player1_id, player2_id, outcome FROM games ORDER BY timestamp, id").fetchall()
+
+    # Removed players are still in the leaderboard, so every game's players have a slot
+    players = cursor.execute("SELECT id, COALESCE(initial_elo, ?) FROM leaderboard",
+                             (elo.DEFAULT_RATING,)).fetchall()
+    player_ids = [player_id for player_id, _ in players]
+    index = {player_id: i for i, player_id in enumerate(player_ids)}
+
+    initial_ratings = dict(players)
+    ratings = np.array([state[player_id][0] if player_id in state else initial_ratings[player_id]
+                        for player_id in player_ids], dtype=np.float64)
+    games_played = np.array([state[player_id][1] if player_id in state else 0 for player_id in player_ids], dtype=np.int64)
+    wins = np.array([state[player_id][2] if player_id in state else 0 for player_id in player_ids], dtype=np.int64)
+    losses = np.array([state[player_id][3] if player_id in state else 0 for player_id in player_ids], dtype=np.int64)
+
+    player1_idx = np.array([index[game[2]] for game in games], dtype=np.int64)
+    player2_idx = np.array([index[game[3]] for game in games], dtype=np.int64)
+    result1 = np.array([1.0 if game[4] == OUTCOMES["p1_wins"] else 0.0 for game in games], dtype=np.float64)
+
+    # Replay in chunks that end on checkpoint boundaries and store a checkpoint after each full one
+    start = 0
+    while start < len(games):
+        end = min(start + CHECKPOINT_INTERVAL - game_count % CHECKPOINT_INTERVAL, len(games))
+        ratings, chunk_games, chunk_wins, chunk_losses, history = elo.replay_history(
+            player1_idx[start:end], player2_idx[start:end], result1[start:end], ratings,
+            k=k, round_ratings=True, history=True)
+        cursor.executemany(RATING_HISTORY_INSERT, _rating_history_rows(
+            [game[:2] for game in games[start:end]], player1_idx[start:end], player2_idx[start:end],
+            player_ids, history, games_played, wins, losses))
+        games_played += chunk_games
+        wins += chunk_wins
+        losses += chunk_losses
+        game_count += end - start
+        if game_count % CHECKPOINT_INTERVAL == 0:
+            last_game_id, last_timestamp = games[end - 1][:2]
+            cursor.executemany(
+                """INSERT INTO rating_checkpoints
+                   (game_count, game_timestamp, game_id, player_id, elo, games_played, wins, losses)
+                   VALUES (?, ?, ?, ?, ?, ?, ?, ?)""",
+                [(game_count, last_timestamp, last_game_id, player_id, float(ratings[i]),
+                  int(games_played[i]), int(wins[i]), int(losses[i]))
+                 for i, player_id in enumerate(player_ids) if games_played[i] > 0])
+        start = end
+
+    if update_leaderboard:
+        cursor.executemany(
+            "UPDATE leaderboard SET elo = ?, games_played = ?, wins = ?, losses = ? WHERE id = ?",
+            [(float(ratings[i]), int(games_played[i]), int(wins[i]), int(losses[i]), player_id)
+             for i, player_id in enumerate(player_ids)])
+    conn.commit()
+    return len(games)
+
+@retry_on_lock
+def checkpoint_if_due(conn):
+    # Snapshot the live leaderboard once CHECKPOINT_INTERVAL games were added since the last checkpoint
+    cursor = conn.cursor()
+    begin_immediate(cursor)
+    try:
+        _checkpoint_if_due(cursor)
         conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
 
-        # Debug: print the number of rows affected
-        print("Inserted game history, rows affected:", conn.total_changes)
+def _checkpoint_if_due(cursor):
+    # The statements of checkpoint_if_due; the caller owns the transaction
+    game_count, new_games = _games_since_checkpoint(cursor)
+    if new_games < CHECKPOINT_INTERVAL:
+        return
+    cursor.execute("SELECT timestamp, id FROM games ORDER BY timestamp DESC, id DESC LIMIT 1")
+    _insert_leaderboard_checkpoint(cursor, game_count + new_games, *cursor.fetchone())
 
-def get_table(database_name):
-    conn = sqlite3.connect(database_name)
+def _checkpoint_if_due_quietly(cursor):
+    # Inside the transaction that recorded games, so they take the write lock once. The
+    # checkpoint has its own savepoint: if it fails, the games are still committed.
+    cursor.execute("SAVEPOINT checkpoint")
+    try:
+        _checkpoint_if_due(cursor)
+    except Error:
+        cursor.execute("ROLLBACK TO checkpoint")
+        logger.exception("Could not store a rating checkpoint")
+    cursor.execute("RELEASE checkpoint")
+
+def _games_since_checkpoint(cursor):
+    # The game count of the latest checkpoint and the number of games after it
+    cursor.execute("SELECT game_count, game_timestamp, game_id FROM rating_checkpoints "
+                   "ORDER BY game_count DESC LIMIT 1")
+    last = cursor.fetchone()
+    if last:
+        game_count, last_timestamp, last_game_id = last
+        cursor.execute("SELECT COUNT(*) FROM games WHERE (timestamp, id) > (?, ?)",
+                       (last_timestamp, last_game_id))
+    else:
+        game_count = 0
+        cursor.execute("SELECT COUNT(*) FROM games")
+    return game_count, cursor.fetchone()[0]
+
+def _insert_leaderboard_checkpoint(cursor, game_count, last_timestamp, last_game_id):
+    # Snapshot the leaderboard as the checkpoint after the game (last_timestamp, last_game_id)
+    cursor.execute("""INSERT INTO rating_checkpoints
+                      (game_count, game_timestamp, game_id, player_id, elo, games_played, wins, losses)
+                      SELECT ?, ?, ?, id, elo, games_played, wins, losses FROM leaderboard
+                      WHERE games_played > 0""",
+                   (game_count, last_timestamp, last_game_id))
+
+def import_games(conn, games, chunk_size=IMPORT_CHUNK_SIZE, k=32):
+    # Bulk insert and rate (timestamp, player1, player2, winner) rows, chunk_size games per
+    # transaction. winner is a player name or p1_wins/p2_wins; unknown players are created at
+    # the default rating. Returns the number of games imported. Rows are checked as they are
+    # read, so an invalid row raises ValueError with the chunks before it already imported;
+    # those are still re-rated into timestamp order.
     cursor = conn.cursor()
-    cursor.execute("SELECT name FROM sqlite_master WHERE type='table';")
-    tables = cursor.fetchall()
-    conn.close()
-    return [table[0] for table in tables]
+    state = {name: [player_id, rating, games_played, wins, losses]
+             for name, player_id, rating, games_played, wins, losses in cursor.execute(
+                 "SELECT name, id, elo, games_played, wins, losses FROM leaderboard WHERE active = 1")}
+    cursor.execute("SELECT MAX(timestamp) FROM games")
+    last_timestamp = cursor.fetchone()[0] or 0
+    # The earliest game rated out of order, among committed chunks and in the current one
+    earliest_out_of_order = chunk_out_of_order = None
+    imported = 0
 
-def get_columns(database_name, table_name):
-    conn = sqlite3.connect(database_name)
+    chunk = []
+    try:
+        for timestamp, player1, player2, winner in games:
+            timestamp = to_epoch_ms(timestamp) if timestamp else now_ms()
+            if player1 == player2:
+                raise ValueError(f"{player1} can't play against themselves")
+            if winner == "p1_wins":
+                winner = player1
+            elif winner == "p2_wins":
+                winner = player2
+            elif winner not in (player1, player2):
+                raise ValueError(f"Winner {winner} did not play in {player1} vs {player2}")
+            if timestamp < last_timestamp:
+                # Rated out of order; fixed by a re-rate once everything is in
+                chunk_out_of_order = timestamp if chunk_out_of_order is None else min(chunk_out_of_order, timestamp)
+            last_timestamp = max(last_timestamp, timestamp)
+            chunk.append((timestamp, player1, player2, winner))
+            if len(chunk) == chunk_size:
+                imported += _import_chunk(conn, chunk, state, k)
+                earliest_out_of_order = _earliest(earliest_out_of_order, chunk_out_of_order)
+                chunk, chunk_out_of_order = [], None
+        if chunk:
+            imported += _import_chunk(conn, chunk, state, k)
+            earliest_out_of_order = _earliest(earliest_out_of_order, chunk_out_of_order)
+    except Exception:
+        logger.error("Import stopped after %d games", imported)
+        raise
+    finally:
+        if earliest_out_of_order is not None:
+            rerate_from(conn, (earliest_out_of_order, 0), k=k)
+        elif imported:
+            _checkpoint_quietly(conn)
+    return imported
+
+def _earliest(*timestamps):
+    timestamps = [timestamp for timestamp in timestamps if timestamp is not None]
+    return min(timestamps) if timestamps else None
+
+def _import_chunk(conn, chunk, state, k):
     cursor = conn.cursor()
-    cursor.execute(f"PRAGMA table_info({table_name})")
-    column_names = [column_info[1] for column_info in cursor.fetchall()]
-    conn.close()
-    return column_names
+    begin_immediate(cursor)
+    try:
+        game_count = sum(_games_since_checkpoint(cursor))
+        new_players = [name for name in dict.fromkeys(name for game in chunk for name in game[1:3])
+                       if name not in state]
+        for name in new_players:
+            cursor.execute("""INSERT INTO leaderboard(name, elo, games_played, wins, losses, initial_elo)
+                              VALUES (?, ?, 0, 0, 0, ?)""", (name, elo.DEFAULT_RATING, elo.DEFAULT_RATING))
+            state[name] = [cursor.lastrowid, elo.DEFAULT_RATING, 0, 0, 0]
+
+        # Ids are given explicitly so the rating history can refer to them; we hold the write lock
+        cursor.execute("SELECT COALESCE(MAX(id), 0) FROM games")
+        first_id = cursor.fetchone()[0] + 1
+        game_ids = range(first_id, first_id + len(chunk))
+        cursor.executemany("INSERT INTO games (id, timestamp, player1_id, player2_id, outcome) VALUES (?, ?, ?, ?, ?)",
+                           [(game_id, timestamp, state[player1][0], state[player2][0], 1 if winner == player1 else 2)
+                            for game_id, (timestamp, player1, player2, winner) in zip(game_ids, chunk)])
+        cursor.executemany(HEAD_TO_HEAD_UPSERT, _head_to_head_rows(
+            (game_id, timestamp, state[player1][0], state[player2][0], state[winner][0])
+            for game_id, (timestamp, player1, player2, winner) in zip(game_ids, chunk)))
+
+        names = list(dict.fromkeys(name for game in chunk for name in game[1:3]))
+        index = {name: i for i, name in enumerate(names)}
+        player_ids = [state[name][0] for name in names]
+        game_keys = [(game_id, game[0]) for game_id, game in zip(game_ids, chunk)]
+        player1_idx = np.array([index[game[1]] for game in chunk], dtype=np.int64)
+        player2_idx = np.array([index[game[2]] for game in chunk], dtype=np.int64)
+        result1 = np.array([1.0 if game[3] == game[1] else 0.0 for game in chunk], dtype=np.float64)
+        ratings = np.array([state[name][1] for name in names], dtype=np.float64)
+        games_played, wins, losses = (np.array([state[name][column] for name in names], dtype=np.int64)
+                                      for column in (2, 3, 4))
+
+        def update_leaderboard():
+            cursor.executemany(
+                "UPDATE leaderboard SET elo = ?, games_played = ?, wins = ?, losses = ? WHERE id = ?",
+                [(float(ratings[i]), int(games_played[i]), int(wins[i]), int(losses[i]), player_id)
+                 for i, player_id in enumerate(player_ids)])
+
+        # Replay in parts that end on checkpoint boundaries, as rerate_from does, and snapshot the
+        # leaderboard after each full one. Games imported out of order get their checkpoints
+        # replaced by the re-rate at the end of import_games.
+        start = 0
+        while start < len(chunk):
+            end = min(start + CHECKPOINT_INTERVAL - game_count % CHECKPOINT_INTERVAL, len(chunk))
+            ratings, part_games, part_wins, part_losses, history = elo.replay_history(
+                player1_idx[start:end], player2_idx[start:end], result1[start:end], ratings,
+                k=k, round_ratings=True, history=True)
+            cursor.executemany(RATING_HISTORY_INSERT, _rating_history_rows(
+                game_keys[start:end], player1_idx[start:end], player2_idx[start:end],
+                player_ids, history, games_played, wins, losses))
+            games_played += part_games
+            wins += part_wins
+            losses += part_losses
+            game_count += end - start
+            if game_count % CHECKPOINT_INTERVAL == 0:
+                update_leaderboard()
+                last_game_id, last_timestamp = game_keys[end - 1]
+                _insert_leaderboard_checkpoint(cursor, game_count, last_timestamp, last_game_id)
+            start = end
+
+        update_leaderboard()
+        for i, name in enumerate(names):
+            state[name][1:] = [float(ratings[i]), int(games_played[i]), int(wins[i]), int(losses[i])]
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return len(chunk)
+
+def _schema(database_name):
+    # Table and column names per database file, reused until PRAGMA schema_version says
+    # the schema changed. Columns are filled in lazily per table.
+    conn = get_connection(database_name)
+    schema_version = conn.execute("PRAGMA schema_version").fetchone()[0]
+    with _schema_cache_lock:
+        cached = _schema_cache.get(database_name)
+        if cached is not None and cached[0] == schema_version:
+            return cached[1]
+    tables = [row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type IN ('table', 'view');")]
+    schema = {"tables": tables, "columns": {}}
+    with _schema_cache_lock:
+        _schema_cache[database_name] = (schema_version, schema)
+    return schema
+
+def get_table(database_name):
+    return list(_schema(database_name)["tables"])
+
+def get_columns(database_name, table_name):
+    schema = _schema(database_name)
+    if table_name not in schema["tables"]:
+        return []
+    column_names = schema["columns"].get(table_name)
+    if column_names is None:
+        cursor = get_connection(database_name).cursor()
+        cursor.execute(f'PRAGMA table_info("{table_name}")')
+        column_names = schema["columns"][table_name] = [column_info[1] for column_info in cursor.fetchall()]
+    return list(column_names)
+
+# Comparison operators get_table_page accepts in filters, mapped to their SQL form
+FILTER_OPERATORS = {"=": "=", "!=": "!=", "<": "<", "<=": "<=", ">": ">", ">=": ">=",
+                    "contains": "LIKE", "startswith": "LIKE"}
+
+def _table_filter_sql(database_name, table_name, filters):
+    # WHERE clause and parameters for (column, operator, value) filters on a known table
+    if table_name not in get_table(database_name):
+        raise ValueError(f"Unknown table: {table_name}")
+    columns = get_columns(database_name, table_name)
+    clauses = []
+    params = []
+    for column, operator, value in filters or []:
+        if column not in columns or operator not in FILTER_OPERATORS:
+            raise ValueError(f"Invalid filter: {column} {operator} {value}")
+        if operator == "contains":
+            value = f"%{value}%"
+        elif operator == "startswith":
+            value = f"{value}%"
+        clauses.append(f'"{column}" {FILTER_OPERATORS[operator]} ?')
+        params.append(value)
+    return (" WHERE " + " AND ".join(clauses) if clauses else ""), params, columns
+
+def get_table_page(database_name, table_name, page_current, page_size, sort_by=None, filters=None):
+    # One page of a table as dicts, sorted by (column, "asc"/"desc") pairs and filtered
+    # by (column, operator, value) triples, so only the visible rows leave the database
+    where, params, columns = _table_filter_sql(database_name, table_name, filters)
+    order = []
+    for column, direction in sort_by or []:
+        if column not in columns:
+            raise ValueError(f"Unknown column: {column}")
+        order.append(f'"{column}" {"DESC" if direction == "desc" else "ASC"}')
+    order_by = " ORDER BY " + ", ".join(order) if order else ""
+
+    cursor = get_connection(database_name).cursor()
+    cursor.execute(f'SELECT * FROM "{table_name}"{where}{order_by} LIMIT ? OFFSET ?',
+                   params + [page_size, page_current * page_size])
+    names = [column[0] for column in cursor.description]
+    return [dict(zip(names, row)) for row in cursor.fetchall()]
+
+def count_table_rows(database_name, table_name, filters=None):
+    where, params, _ = _table_filter_sql(database_name, table_name, filters)
+    cursor = get_connection(database_name).cursor()
+    cursor.execute(f'SELECT COUNT(*) FROM "{table_name}"{where}', params)
+    return cursor.fetchone()[0]
+
+@retry_on_lock
+def apply_table_changes(database_name, table_name, updates, deleted_ids):
+    # Apply (row_id, column, value) cell updates and row deletions in one transaction
+    columns = get_columns(database_name, table_name)
+    if not columns:
+        raise ValueError(f"Unknown table: {table_name}")
+    if "id" not in columns:
+        raise ValueError(f"Table {table_name} has no id column")
+    by_column = {}
+    for row_id, column, value in updates:
+        if column not in columns or column == "id":
+            raise ValueError(f"Cannot update column {column} of {table_name}")
+        by_column.setdefault(column, []).append((value, row_id))
+
+    conn = get_connection(database_name)
+    with conn:
+        cursor = conn.cursor()
+        begin_immediate(cursor)
+        for column, rows in by_column.items():
+            cursor.executemany(f'UPDATE "{table_name}" SET "{column}" = ? WHERE id = ?', rows)
+        cursor.executemany(f'DELETE FROM "{table_name}" WHERE id = ?', [(row_id,) for row_id in deleted_ids])
 
+@retry_on_lock
 def update_row_in_db(database_name, table_name, row_id, column_name, new_value):
-    conn = sqlite3.connect(database_name)
+    conn = get_connection(database_name)
     cursor = conn.cursor()
     cursor.execute(f"UPDATE {table_name} SET {column_name} = ? WHERE id = ?", (new_value, row_id))
     conn.commit()
-    conn.close()
 
+@retry_on_lock
 def delete_row_from_db(database_name, table_name, row_id):
-    conn = sqlite3.connect(database_name)
+    conn = get_connection(database_name)
     cursor = conn.cursor()
     cursor.execute(f"DELETE FROM {table_name} WHERE id = ?", (row_id,))
     conn.commit()
-    conn.close()
\ No newline at end of file
@@ -1,6 +1,45 @@
+import numpy as np
+
+DEFAULT_RATING = 1000
+
+# Per-player columns of the game history returned by replay_history(history=True)
+HISTORY_COLUMNS = ("elo_before", "elo_after", "games_played", "wins", "losses")
+
+
 def expected_outcome(rating1, rating2):
     return 1 / (1 + 10 ** ((rating2 - rating1) / 400))
 
+def expected_score_matrix(ratings):
+    # Expected score of the row player against the column player, for every pair at once
+    ratings = np.asarray(ratings, dtype=np.float64)
+    return expected_outcome(ratings[:, None], ratings[None, :])
+
+class ExpectedScoreMatrix:
+    # expected_score_matrix kept in step with changing ratings. update() only recomputes
+    # the rows and columns of players whose rating moved, and never modifies a matrix it
+    # has already handed out, so callers may keep using an older one.
+    def __init__(self, ratings):
+        self.ratings = np.array(ratings, dtype=np.float64)
+        self.matrix = expected_score_matrix(self.ratings)
+
+    def update(self, ratings):
+        ratings = np.array(ratings, dtype=np.float64)
+        if ratings.shape != self.ratings.shape:
+            self.__init__(ratings)
+            return
+        changed = np.flatnonzero(ratings != self.ratings)
+        if len(changed) == 0:
+            return
+        if 2 * len(changed) >= len(ratings):
+            # Most of the matrix is stale anyway
+            self.__init__(ratings)
+            return
+        matrix = self.matrix.copy()
+        matrix[changed, :] = expected_outcome(ratings[changed, None], ratings[None, :])
+        matrix[:, changed] = expected_outcome(ratings[:, None], ratings[None, changed])
+        self.ratings = ratings
+        self.matrix = matrix
+
 def update_elo(rating1, rating2, result1, k=32):
     expected1 = expected_outcome(rating1, rating2)
     expected2 = expected_outcome(rating2, rating1)
@@ -9,3 +48,58 @@ def update_elo(rating1, rating2, result1, k=32):
     new_rating2 = rating2 + k * ((1 - result1) - expected2)
 
     return new_rating1, new_rating2
+
+def replay_history(player1_idx, player2_idx, result1, initial_ratings, k=32, round_ratings=False, history=False):
+    # Replays a whole game history in order. Players are positions in the dense
+    # initial_ratings array; returns ratings, games, wins and losses per position.
+    # With history=True a per-game array is returned as well, with the columns in
+    # HISTORY_COLUMNS for player 1 followed by the same for player 2. Its counters
+    # count from the start of this replay.
+    player1_idx = np.asarray(player1_idx, dtype=np.int64)
+    player2_idx = np.asarray(player2_idx, dtype=np.int64)
+    result1 = np.asarray(result1, dtype=np.float64)
+    ratings = np.array(initial_ratings, dtype=np.float64)
+    n = len(ratings)
+
+    # The counters don't depend on game order, so they are computed in bulk
+    games = np.bincount(player1_idx, minlength=n) + np.bincount(player2_idx, minlength=n)
+    p1_won = result1 == 1
+    p2_won = result1 == 0
+    wins = (np.bincount(player1_idx[p1_won], minlength=n)
+            + np.bincount(player2_idx[p2_won], minlength=n))
+    losses = (np.bincount(player1_idx[p2_won], minlength=n)
+              + np.bincount(player2_idx[p1_won], minlength=n))
+
+    # Every game depends on the ratings left by the previous one, so this pass
+    # stays sequential; plain floats avoid the numpy scalar overhead per game.
+    r = ratings.tolist()
+    if history:
+        g = [0] * n
+        w = [0] * n
+        l = [0] * n
+        rows = []
+    for i, j, s in zip(player1_idx.tolist(), player2_idx.tolist(), result1.tolist()):
+        r1 = r[i]
+        r2 = r[j]
+        new_r1 = r1 + k * (s - 1 / (1 + 10 ** ((r2 - r1) / 400)))
+        new_r2 = r2 + k * ((1 - s) - 1 / (1 + 10 ** ((r1 - r2) / 400)))
+        if round_ratings:
+            new_r1 = round(new_r1)
+            new_r2 = round(new_r2)
+        r[i] = new_r1
+        r[j] = new_r2
+        if history:
+            g[i] += 1
+            g[j] += 1
+            if s == 1:
+                w[i] += 1
+                l[j] += 1
+            elif s == 0:
+                l[i] += 1
+                w[j] += 1
+            rows.append((r1, new_r1, g[i], w[i], l[i], r2, new_r2, g[j], w[j], l[j]))
+
+    if history:
+        return (np.array(r, dtype=np.float64), games, wins, losses,
+                np.array(rows, dtype=np.float64).reshape(-1, 2 * len(HISTORY_COLUMNS)))
+    return np.array(r, dtype=np.float64), games, wins, losses
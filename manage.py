@@ -0,0 +1,73 @@
+# manage.py
+
+import argparse
+import csv
+import json
+import sys
+import time
+
+import db
+
+
+def read_games(path, file_format=None):
+    # Stream (timestamp, player1, player2, winner) rows from a CSV or JSON-lines file
+    file_format = file_format or ("jsonl" if path.endswith((".jsonl", ".ndjson")) else "csv")
+    with (sys.stdin if path == "-" else open(path, newline="")) as f:
+        if file_format == "csv":
+            for row in csv.DictReader(f):
+                yield row.get("timestamp"), row["player1"], row["player2"], row["winner"]
+        else:
+            for line in f:
+                if line.strip():
+                    row = json.loads(line)
+                    yield row.get("timestamp"), row["player1"], row["player2"], row["winner"]
+
+
+def import_games(args):
+    conn = db.create_connection(args.db)
+    db.create_tables(conn)
+    started = time.perf_counter()
+    imported = db.import_games(conn, read_games(args.path, args.format), chunk_size=args.chunk_size)
+    print(f"Imported {imported} games in {time.perf_counter() - started:.2f}s")
+
+
+def replay(args):
+    conn = db.create_connection(args.db)
+    db.create_tables(conn)
+    started = time.perf_counter()
+    replayed = db.replay_game_history(conn)
+    print(f"Replayed {replayed} games in {time.perf_counter() - started:.2f}s")
+
+
+def rebuild_head_to_head(args):
+    conn = db.create_connection(args.db)
+    db.create_tables(conn)
+    started = time.perf_counter()
+    pairs = db.rebuild_head_to_head(conn)
+    print(f"Rebuilt head-to-head statistics for {pairs} pairs in {time.perf_counter() - started:.2f}s")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Maintenance commands for the Elo leaderboard database")
+    parser.add_argument("--db", default="leaderboard.db", help="database file")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    import_parser = commands.add_parser("import-games", help="bulk import games from CSV or JSON lines")
+    import_parser.add_argument("path", help="input file with timestamp, player1, player2 and winner; - for stdin")
+    import_parser.add_argument("--format", choices=["csv", "jsonl"], help="defaults to the file extension")
+    import_parser.add_argument("--chunk-size", type=int, default=db.IMPORT_CHUNK_SIZE, help="games per transaction")
+    import_parser.set_defaults(func=import_games)
+
+    replay_parser = commands.add_parser("replay", help="recompute all ratings from the game history")
+    replay_parser.set_defaults(func=replay)
+
+    head_to_head_parser = commands.add_parser("rebuild-head-to-head",
+                                              help="recompute the head-to-head table from the game history")
+    head_to_head_parser.set_defaults(func=rebuild_head_to_head)
+
+    args = parser.parse_args(argv)
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,136 @@
+# test_db.py
+
+import sqlite3
+
+import pytest
+
+import db
+
+
+# The schema databases were created with before games moved to player ids
+LEGACY_SCHEMA = """
+CREATE TABLE leaderboard (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL,
+    elo REAL NOT NULL,
+    games_played INTEGER NOT NULL,
+    wins INTEGER NOT NULL,
+    losses INTEGER NOT NULL
+);
+CREATE TABLE game_history (
+    id INTEGER PRIMARY KEY,
+    timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
+    player1 TEXT NOT NULL,
+    player2 TEXT NOT NULL,
+    winner TEXT NOT NULL
+);
+"""
+
+LEGACY_PLAYERS = [
+    (1, "Anna", 1016.0, 3, 2, 1),
+    (2, "Bram", 984.0, 3, 1, 2),
+    (3, "Cas", 1000.0, 0, 0, 0),
+]
+
+# Dora was removed before the migration and only lives on in her game. Old rows may store
+# p1_wins/p2_wins as the winner, and a game of a player against themselves is dropped.
+LEGACY_GAMES = [
+    (1, "2023-04-11 20:36:49.216761", "Anna", "Bram", "Anna"),
+    (2, "2023-04-11 20:37:10", "Bram", "Anna", "p1_wins"),
+    (3, "2023-04-12 09:00:00.5", "Anna", "Bram", "p1_wins"),
+    (4, "2023-04-12 10:15:00", "Dora", "Anna", "p2_wins"),
+    (5, "2023-04-12 11:00:00", "Bram", "Bram", "Bram"),
+]
+
+
+@pytest.fixture
+def legacy_db(tmp_path):
+    db_file = str(tmp_path / "legacy.db")
+    conn = sqlite3.connect(db_file)
+    conn.executescript(LEGACY_SCHEMA)
+    conn.executemany("INSERT INTO leaderboard VALUES (?, ?, ?, ?, ?, ?)", LEGACY_PLAYERS)
+    conn.executemany("INSERT INTO game_history VALUES (?, ?, ?, ?, ?)", LEGACY_GAMES)
+    conn.commit()
+    conn.close()
+    db.ensure_tables(db_file)
+    yield db_file, db.get_connection(db_file)
+    db.close_connections()
+
+
+def test_migration_keeps_games_and_outcomes(legacy_db):
+    db_file, conn = legacy_db
+    ids = dict(conn.execute("SELECT name, id FROM leaderboard"))
+    games = conn.execute("SELECT id, timestamp, player1_id, player2_id, outcome FROM games ORDER BY id").fetchall()
+    assert games == [
+        (1, db.to_epoch_ms("2023-04-11 20:36:49.216761"), ids["Anna"], ids["Bram"], 1),
+        (2, db.to_epoch_ms("2023-04-11 20:37:10"), ids["Bram"], ids["Anna"], 1),
+        (3, db.to_epoch_ms("2023-04-12 09:00:00.5"), ids["Anna"], ids["Bram"], 1),
+        (4, db.to_epoch_ms("2023-04-12 10:15:00"), ids["Dora"], ids["Anna"], 2),
+    ]
+    assert all(type(timestamp) is int for _, timestamp, _, _, _ in games)
+
+
+def test_migration_keeps_the_leaderboard(legacy_db):
+    db_file, conn = legacy_db
+    players = conn.execute("SELECT id, name, elo, games_played, wins, losses FROM leaderboard WHERE active = 1 "
+                           "ORDER BY id").fetchall()
+    assert players == LEGACY_PLAYERS
+    assert conn.execute("SELECT active FROM leaderboard WHERE name = 'Dora'").fetchone() == (0,)
+    # The rating history is backfilled from the games
+    assert conn.execute("SELECT COUNT(*) FROM rating_history").fetchone() == (8,)
+
+
+def test_game_history_view_reads_and_edits(legacy_db):
+    db_file, conn = legacy_db
+    assert conn.execute("SELECT player1, player2, winner FROM game_history ORDER BY id").fetchall() == [
+        ("Anna", "Bram", "Anna"),
+        ("Bram", "Anna", "Bram"),
+        ("Anna", "Bram", "Anna"),
+        ("Dora", "Anna", "Anna"),
+    ]
+    assert conn.execute("SELECT timestamp FROM game_history WHERE id = 3").fetchone() == ("2023-04-12 09:00:00.500",)
+
+    # Another player in the winner's slot keeps the result
+    conn.execute("UPDATE game_history SET player1 = 'Cas' WHERE id = 1")
+    # A new winner flips the outcome
+    conn.execute("UPDATE game_history SET winner = 'Anna' WHERE id = 2")
+    conn.execute("UPDATE game_history SET timestamp = '2023-04-13 08:00:00' WHERE id = 3")
+    # Games of removed players stay editable
+    conn.execute("UPDATE game_history SET winner = 'Dora' WHERE id = 4")
+    conn.execute("DELETE FROM game_history WHERE id = 2")
+    conn.execute("INSERT INTO game_history (timestamp, player1, player2, winner) "
+                 "VALUES ('2023-04-14 12:00:00', 'Cas', 'Bram', 'Bram')")
+    conn.commit()
+
+    assert conn.execute("SELECT player1, player2, winner FROM game_history ORDER BY id").fetchall() == [
+        ("Cas", "Bram", "Cas"),
+        ("Anna", "Bram", "Anna"),
+        ("Dora", "Anna", "Dora"),
+        ("Cas", "Bram", "Bram"),
+    ]
+    assert conn.execute("SELECT timestamp FROM games WHERE id = 3").fetchone() == (
+        db.to_epoch_ms("2023-04-13 08:00:00"),)
+    with pytest.raises(sqlite3.IntegrityError):
+        conn.execute("UPDATE game_history SET player1 = 'Bram' WHERE id = 1")
+    conn.rollback()
+
+
+def test_migration_runs_once(legacy_db):
+    db_file, conn = legacy_db
+    schema_version = conn.execute("PRAGMA schema_version").fetchone()
+    assert db.create_tables(conn)
+    assert conn.execute("PRAGMA schema_version").fetchone() == schema_version
+    assert conn.execute("SELECT COUNT(*) FROM games").fetchone() == (4,)
+
+
+def test_recorded_games_match_a_replay(legacy_db):
+    db_file, conn = legacy_db
+    db.replay_game_history(conn)
+    for player1, player2, result in [("Anna", "Cas", "p1_wins"), ("Cas", "Bram", "p2_wins"),
+                                     ("Bram", "Anna", "p1_wins")]:
+        db.record_game(conn, player1, player2, result)
+    recorded = conn.execute("SELECT id, elo, games_played, wins, losses FROM leaderboard ORDER BY id").fetchall()
+    history = conn.execute("SELECT * FROM rating_history ORDER BY game_id, player_id").fetchall()
+    db.replay_game_history(conn)
+    assert conn.execute("SELECT id, elo, games_played, wins, losses FROM leaderboard ORDER BY id").fetchall() == recorded
+    assert conn.execute("SELECT * FROM rating_history ORDER BY game_id, player_id").fetchall() == history